@@ -28,6 +28,7 @@ admin.site.register(PostGameSurvey)
 admin.site.register(PostGameSurveyOption)
 admin.site.register(PostGameSurveyResponse)
 admin.site.register(Report)
+admin.site.register(ReportAttachment)
 admin.site.register(ReportUpdate)
 admin.site.register(BodyArmor)
 admin.site.register(Rules)
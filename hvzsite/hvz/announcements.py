@@ -0,0 +1,33 @@
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .caching import invalidated_cache_seconds
+
+ANNOUNCEMENTS_CACHE_KEY = 'active_announcements'
+# Changing an announcement clears the cache, so this only bounds how long other workers can miss it with a per-process cache
+ANNOUNCEMENTS_CACHE_SECONDS = invalidated_cache_seconds(24 * 60 * 60)
+
+
+def get_active_announcements():
+    '''
+    Gets the active announcements, newest first, along with the banner that lists them on every page.
+    Both are shared by every user and cached until an announcement changes.
+
+    Returns:
+      (list, str): The Announcements, and the rendered banner HTML
+    '''
+    cached = cache.get(ANNOUNCEMENTS_CACHE_KEY)
+    if cached is None:
+        Announcement = apps.get_model('hvz', 'Announcement')
+        announcements = list(Announcement.objects.filter(active=True).order_by('-post_time'))
+        cached = (announcements, render_to_string("announcement_banner.html", {'announcements': announcements}))
+        cache.set(ANNOUNCEMENTS_CACHE_KEY, cached, ANNOUNCEMENTS_CACHE_SECONDS)
+    announcements, banner = cached
+    return announcements, mark_safe(banner)
+
+
+def invalidate_announcements():
+    transaction.on_commit(lambda: cache.delete(ANNOUNCEMENTS_CACHE_KEY))
@@ -0,0 +1,63 @@
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Func, Subquery
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def count_subquery(queryset):
+    '''
+    Gets an expression counting the rows of `queryset` (which may use OuterRef), for use as an annotation.
+    '''
+    return Coalesce(Subquery(queryset.order_by().annotate(count=Func(F('id'), function='COUNT')).values('count')), 0)
+
+
+def stream_json(key, items, extra=None):
+    '''
+    Encodes `{key: [items...], **extra()}` as JSON a piece at a time, so a large export never sits in memory.
+
+    Params:
+      key: The name of the list
+      items: An iterable of JSON-serializable items (UUIDs and datetimes are fine)
+      extra: Optional function returning more members for the object, called once every item is out
+    '''
+    encoder = DjangoJSONEncoder()
+    yield '{' + json.dumps(key) + ': ['
+    for index, item in enumerate(items):
+        yield (', ' if index else '') + encoder.encode(item)
+    yield ']'
+    for name, value in (extra() if extra else {}).items():
+        yield ', ' + json.dumps(name) + ': ' + encoder.encode(value)
+    yield '}'
+
+
+def streaming_json_response(key, items, extra=None):
+    return StreamingHttpResponse(stream_json(key, items, extra), content_type='application/json')
+
+
+def encode_cursor(timestamp, id):
+    '''
+    Encodes a position in a list ordered by (timestamp, id) as a URL-safe string, exact to the microsecond.
+    '''
+    return f"{(timestamp - EPOCH) // datetime.timedelta(microseconds=1)}-{id}"
+
+
+def decode_cursor(cursor):
+    '''
+    Decodes a cursor made by encode_cursor.
+
+    Returns:
+      (datetime, int): The timestamp and id the cursor points at
+
+    Raises:
+      ValueError: If the cursor is malformed
+    '''
+    microseconds, _, id = cursor.partition('-')
+    try:
+        return EPOCH + datetime.timedelta(microseconds=int(microseconds)), int(id)
+    except OverflowError:
+        raise ValueError("Cursor is out of range")
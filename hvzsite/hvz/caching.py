@@ -0,0 +1,46 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+# Everything derived from clans and their membership, bumped whenever either changes (see models.py)
+CLAN_CACHE_NAMESPACE = 'clans'
+# API keys that passed verification (see permissions.py), bumped whenever a key changes or is deleted
+API_KEY_CACHE_NAMESPACE = 'api_keys'
+
+
+# Longest anything that relies on invalidation may be cached for when each process has its own cache,
+# since invalidations then only reach the process that made them
+LOCAL_CACHE_SECONDS = 60
+
+
+def invalidated_cache_seconds(seconds):
+    '''
+    Gets how long to cache something that is normally kept until invalidated: `seconds` with a shared cache,
+    but no more than LOCAL_CACHE_SECONDS with the default per-process one.
+    '''
+    if settings.CACHES['default']['BACKEND'] == 'django.core.cache.backends.locmem.LocMemCache':
+        return min(seconds, LOCAL_CACHE_SECONDS)
+    return seconds
+
+
+def get_cache_version(namespace):
+    '''
+    Gets the current version of a cache namespace. Every key built with versioned_key includes it,
+    so bumping the version drops everything cached under the namespace at once.
+    '''
+    return cache.get_or_set(f"version:{namespace}", lambda: uuid.uuid4().hex, None)
+
+
+def bump_cache_version(namespace):
+    '''
+    Invalidates everything cached under a namespace once the surrounding transaction commits, so a
+    request can never re-cache the data it is about to replace. Versions are random rather than
+    counters, so a version evicted from the cache can never come back and revive stale entries.
+    '''
+    transaction.on_commit(lambda: cache.set(f"version:{namespace}", uuid.uuid4().hex, None))
+
+
+def versioned_key(namespace, *parts):
+    return ':'.join([namespace, get_cache_version(namespace), *map(str, parts)])
@@ -0,0 +1,353 @@
+import base64
+import html
+import zipfile
+from collections import deque
+from io import BytesIO
+from itertools import islice
+from typing import NamedTuple
+from xml.sax.saxutils import escape, quoteattr
+
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+from django.apps import apps
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.files.storage import default_storage
+from django.db.models import Case, CharField, F, Value, When
+from django.db.models.functions import Concat, Lower
+from django.templatetags.static import static
+
+from .codes import draw_modules, modules_to_svg_path, qr_modules
+from .images import get_executor
+from .media import signed_media_url
+
+# Sheets are laid out in 1/300ths of an inch, which is also the resolution of the PDF
+DPI = 300
+CARD_WIDTH, CARD_HEIGHT = 35 * DPI // 10, 2 * DPI
+SHEET_WIDTH, SHEET_HEIGHT = 85 * DPI // 10, 11 * DPI
+CARD_COLUMNS, CARD_ROWS = 2, 4
+CARDS_PER_SHEET = CARD_COLUMNS * CARD_ROWS
+# The print queue is handed out a batch of this many cards (5 full sheets) at a time
+PRINT_QUEUE_BATCH_SIZE = CARDS_PER_SHEET * 5
+SHEET_MARGIN_X = (SHEET_WIDTH - CARD_COLUMNS * CARD_WIDTH) // 2
+SHEET_MARGIN_Y = (SHEET_HEIGHT - CARD_ROWS * CARD_HEIGHT) // 2
+
+BORDER_WIDTH = DPI // 10
+BORDER_RADIUS = DPI // 10
+BORDER_COLORS = {'admin': '#EEEE00', 'mod': '#0000CC', '': '#00CC00'}
+PHOTO_SIZE = CODE_SIZE = 280
+PHOTO_LEFT, CODE_LEFT, PHOTO_TOP = 60, CARD_WIDTH - 60 - CODE_SIZE, 105
+NAME_LEFT, NAME_TOP, NAME_WIDTH, NAME_SIZE = 50, 40, CARD_WIDTH - 100, 48
+ID_LINES_TOP, ID_LINE_HEIGHT, ID_SIZE = 405, 55, 38
+
+# Preview cards keep the real photo and name, but show this code and no ids
+PREVIEW_CODE_VALUE = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+
+
+class CardRecord(NamedTuple):
+    '''
+    Everything printed on one player's ID card. Records are plain data so they can be rendered off the request thread.
+    '''
+    player_uuid: str
+    name: str
+    role: str
+    picture: str
+    picture_url: str
+    zombie_id: str
+    tag1_id: str
+    tag2_id: str
+    status_id: int
+
+    @property
+    def id_card_values(self):
+        return f"{self.tag1_id}|{self.tag2_id}|{self.zombie_id}"
+
+
+class SheetOptions(NamedTuple):
+    format: str
+    preview: bool
+    url: str
+    font: str
+
+
+def card_records(statuses):
+    '''
+    Builds the card records for some PlayerStatuses (and their players) with a single query,
+    loading only the columns that end up on the cards.
+
+    Params:
+      statuses: A PlayerStatus queryset, in the order the cards should be printed
+    '''
+    statuses = statuses.select_related('player').only(
+        'status', 'zombie_uuid', 'tag1_uuid', 'tag2_uuid', 'player', 'player__player_uuid', 'player__first_name',
+        'player__last_name', 'player__is_superuser', 'player__picture', 'player__picture_derivatives')
+    records = []
+    for status in statuses:
+        player = status.player
+        # NOTE: A superuser is ALWAYS considered an admin
+        role = 'admin' if player.is_superuser or status.is_admin() else 'mod' if status.is_mod() else ''
+        picture = player.picture_derivative_name('full')
+        records.append(CardRecord(str(player.player_uuid), html.unescape(f"{player.first_name} {player.last_name}"), role,
+                                  picture, signed_media_url(picture) if picture else static(player.picture_placeholder),
+                                  status.zombie_uuid, status.tag1_uuid, status.tag2_uuid, status.id))
+    return records
+
+
+def card_codes():
+    '''
+    Gets an expression for the codes currently on a PlayerStatus's card, in the form stored in `printed_codes`
+    (the same as CardRecord.id_card_values).
+    '''
+    return Concat('tag1_uuid', Value('|'), 'tag2_uuid', Value('|'), 'zombie_uuid', output_field=CharField())
+
+
+def outstanding_cards(game):
+    '''
+    Gets the PlayerStatuses of a game whose card still has to be printed: those that were never printed,
+    and those whose codes changed (e.g. were regenerated) since their card was printed.
+    '''
+    PlayerStatus = apps.get_model('hvz', 'PlayerStatus')
+    return PlayerStatus.objects.filter(game=game).exclude(status='n').alias(card_codes=card_codes()) \
+        .exclude(printed=True, printed_codes=F('card_codes')) \
+        .order_by(Lower('player__first_name'), Lower('player__last_name'), 'id')
+
+
+def record_printed_cards(printed):
+    '''
+    Records that some cards were printed, with a single UPDATE.
+
+    Params:
+      printed: {PlayerStatus id: the id_card_values on its printed card}. Recording the printed codes, rather than the
+        current ones, keeps a card in the queue if its codes were regenerated while the batch was being printed
+
+    Returns:
+      int: The number of statuses updated
+    '''
+    if not printed:
+        return 0
+    PlayerStatus = apps.get_model('hvz', 'PlayerStatus')
+    return PlayerStatus.objects.filter(id__in=printed).update(
+        printed=True,
+        printed_codes=Case(*(When(id=status_id, then=Value(codes)) for status_id, codes in printed.items()), output_field=CharField()))
+
+
+def card_code_value(record, options):
+    return PREVIEW_CODE_VALUE if options.preview else f"{options.url}/tag/?scan={record.id_card_values}"
+
+
+def card_id_lines(record, options):
+    ids = ('', '', '') if options.preview else (record.zombie_id, record.tag1_id, record.tag2_id)
+    return [f"Zombie Id: {ids[0]}", f"Human Id #1: {ids[1]}", f"Human Id #2: {ids[2]}"]
+
+
+def load_photo(path):
+    with Image.open(path) as im:
+        return ImageOps.fit(im.convert('RGB'), (PHOTO_SIZE, PHOTO_SIZE), Image.Resampling.LANCZOS)
+
+
+def load_font(options, size):
+    if options.font:
+        return ImageFont.truetype(options.font, size)
+    return ImageFont.load_default(size)
+
+
+def draw_card(sheet, draw, left, top, record, photo_path, options):
+    draw.rounded_rectangle((left, top, left + CARD_WIDTH - 1, top + CARD_HEIGHT - 1), radius=BORDER_RADIUS,
+                           fill='white', outline=BORDER_COLORS[record.role], width=BORDER_WIDTH)
+    # Long names get smaller rather than cut off
+    size = NAME_SIZE
+    font = load_font(options, size)
+    while size > 20 and draw.textlength(record.name, font=font) > NAME_WIDTH:
+        size -= 2
+        font = load_font(options, size)
+    draw.text((left + NAME_LEFT, top + NAME_TOP), record.name, fill='black', font=font)
+    sheet.paste(load_photo(photo_path), (left + PHOTO_LEFT, top + PHOTO_TOP))
+    draw_modules(draw, qr_modules(card_code_value(record, options)), left + CODE_LEFT, top + PHOTO_TOP, CODE_SIZE)
+    font = load_font(options, ID_SIZE)
+    for index, line in enumerate(card_id_lines(record, options)):
+        y = top + ID_LINES_TOP + index * ID_LINE_HEIGHT
+        draw.text((left + CARD_WIDTH // 2, y + ID_LINE_HEIGHT // 2), line, fill='black', font=font, anchor='mm')
+        if index == 1:
+            draw.line((left + BORDER_WIDTH, y, left + CARD_WIDTH - BORDER_WIDTH, y), fill='black', width=2)
+            draw.line((left + BORDER_WIDTH, y + ID_LINE_HEIGHT, left + CARD_WIDTH - BORDER_WIDTH, y + ID_LINE_HEIGHT), fill='black', width=2)
+
+
+def svg_card(left, top, record, photo_path, options):
+    output = BytesIO()
+    load_photo(photo_path).save(output, format='JPEG', quality=90)
+    photo = base64.b64encode(output.getvalue()).decode()
+    half = BORDER_WIDTH // 2
+    # Long names get squeezed rather than cut off
+    name_fit = f' textLength="{NAME_WIDTH}" lengthAdjust="spacingAndGlyphs"' if len(record.name) > 37 else ''
+    parts = [
+        f'<g transform="translate({left},{top})">',
+        f'<rect x="{half}" y="{half}" width="{CARD_WIDTH - BORDER_WIDTH}" height="{CARD_HEIGHT - BORDER_WIDTH}" rx="{BORDER_RADIUS}" '
+        f'fill="#fff" stroke="{BORDER_COLORS[record.role]}" stroke-width="{BORDER_WIDTH}"/>',
+        f'<text x="{NAME_LEFT}" y="{NAME_TOP + NAME_SIZE}" font-size="{NAME_SIZE}" font-weight="bold"{name_fit}>{escape(record.name)}</text>',
+        f'<image x="{PHOTO_LEFT}" y="{PHOTO_TOP}" width="{PHOTO_SIZE}" height="{PHOTO_SIZE}" href="data:image/jpeg;base64,{photo}"/>',
+    ]
+    modules = qr_modules(card_code_value(record, options))
+    scale = CODE_SIZE / len(modules)
+    parts.append(f'<path transform="translate({CODE_LEFT},{PHOTO_TOP}) scale({scale:.4f})" d="{modules_to_svg_path(modules)}"/>')
+    for index, line in enumerate(card_id_lines(record, options)):
+        y = ID_LINES_TOP + index * ID_LINE_HEIGHT
+        parts.append(f'<text x="{CARD_WIDTH // 2}" y="{y + ID_LINE_HEIGHT // 2}" font-size="{ID_SIZE}" '
+                     f'text-anchor="middle" dominant-baseline="central">{escape(line)}</text>')
+        if index == 1:
+            parts.append(f'<path d="M{BORDER_WIDTH} {y}H{CARD_WIDTH - BORDER_WIDTH}M{BORDER_WIDTH} {y + ID_LINE_HEIGHT}H{CARD_WIDTH - BORDER_WIDTH}" '
+                         f'stroke="#000" stroke-width="2"/>')
+    parts.append('</g>')
+    return ''.join(parts)
+
+
+def card_position(index):
+    return SHEET_MARGIN_X + (index % CARD_COLUMNS) * CARD_WIDTH, SHEET_MARGIN_Y + (index // CARD_COLUMNS) * CARD_HEIGHT
+
+
+def render_sheet(cards, options):
+    '''
+    Renders one sheet of cards. Meant to run on a worker thread, so it must not touch the database.
+
+    Params:
+      cards: Up to CARDS_PER_SHEET (CardRecord, absolute path of the photo to print) pairs
+      options: The SheetOptions of the whole print job
+
+    Returns:
+      bytes: The page, as a JPEG for 'pdf' or an SVG document for 'svg'
+    '''
+    if options.format == 'svg':
+        cards = ''.join(svg_card(*card_position(index), record, photo_path, options) for index, (record, photo_path) in enumerate(cards))
+        font = quoteattr("'Droid Sans Mono', monospace")
+        return (f'<svg xmlns="http://www.w3.org/2000/svg" width="8.5in" height="11in" viewBox="0 0 {SHEET_WIDTH} {SHEET_HEIGHT}" '
+                f'font-family={font}>{cards}</svg>').encode()
+    sheet = Image.new('RGB', (SHEET_WIDTH, SHEET_HEIGHT), 'white')
+    draw = ImageDraw.Draw(sheet)
+    for index, (record, photo_path) in enumerate(cards):
+        draw_card(sheet, draw, *card_position(index), record, photo_path, options)
+    output = BytesIO()
+    sheet.save(output, format='JPEG', quality=90, dpi=(DPI, DPI))
+    return output.getvalue()
+
+
+def pdf_document(pages, page_count):
+    '''
+    Yields a PDF with one full-page JPEG image per page, writing each page out as soon as it is rendered.
+
+    Params:
+      pages: An iterable of JPEG pages, each SHEET_WIDTH by SHEET_HEIGHT
+      page_count: How many pages `pages` will produce
+    '''
+    offsets = {}
+    written = 0
+
+    def write_object(number, dictionary, stream=None):
+        nonlocal written
+        offsets[number] = written
+        data = f"{number} 0 obj\n{dictionary}\n".encode()
+        if stream is not None:
+            data += b"stream\n" + stream + b"\nendstream\n"
+        data += b"endobj\n"
+        written += len(data)
+        return data
+
+    header = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+    written = len(header)
+    yield header
+    # Objects 1 and 2 are the catalog and page tree; each page then takes three: the page, its content and its image
+    kids = ' '.join(f"{3 + 3 * index} 0 R" for index in range(page_count))
+    yield write_object(1, "<< /Type /Catalog /Pages 2 0 R >>")
+    yield write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {page_count} >>")
+    width, height = SHEET_WIDTH * 72 // DPI, SHEET_HEIGHT * 72 // DPI
+    for index, page in enumerate(pages):
+        number = 3 + 3 * index
+        content = f"q {width} 0 0 {height} 0 0 cm /Sheet Do Q".encode()
+        yield write_object(number, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] "
+                                   f"/Resources << /XObject << /Sheet {number + 2} 0 R >> >> /Contents {number + 1} 0 R >>")
+        yield write_object(number + 1, f"<< /Length {len(content)} >>", content)
+        yield write_object(number + 2, f"<< /Type /XObject /Subtype /Image /Width {SHEET_WIDTH} /Height {SHEET_HEIGHT} "
+                                       f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode /Length {len(page)} >>", page)
+    xref = [f"xref\n0 {len(offsets) + 1}\n", "0000000000 65535 f \n"]
+    xref.extend(f"{offsets[number]:010d} 00000 n \n" for number in sorted(offsets))
+    yield (''.join(xref) + f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{written}\n%%EOF\n").encode()
+
+
+class _ChunkBuffer:
+    '''
+    A write-only file that hands back whatever was written since it was last emptied, for streaming a zip archive.
+    '''
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_archive(files):
+    '''
+    Yields a zip archive of (name, data) pairs, writing each file out as soon as it is produced.
+    '''
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+            yield buffer.take()
+    yield buffer.take()
+
+
+def photo_path(record):
+    if record.picture:
+        return default_storage.path(record.picture)
+    return finders.find('images/noprofile.png')
+
+
+def render_pages(sheets, options):
+    '''
+    Renders sheets in order on the shared picture worker pool (see images.get_executor).
+    Only a few sheets are queued ahead of the one being sent, and they are cancelled if the
+    generator is closed early (e.g. the client disconnected), so an abandoned download stops rendering.
+    '''
+    executor = get_executor()
+    sheets = iter(sheets)
+    pending = deque(executor.submit(render_sheet, sheet, options) for sheet in islice(sheets, settings.IMAGE_PROCESSING_WORKERS))
+    try:
+        while pending:
+            page = pending.popleft().result()
+            pending.extend(executor.submit(render_sheet, sheet, options) for sheet in islice(sheets, 1))
+            yield page
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def render_card_sheets(records, format, preview, url):
+    '''
+    Renders print-ready ID card sheets, spreading the sheets across the picture worker pool.
+
+    Params:
+      records: The CardRecords to print, in order
+      format: 'pdf' for one document, or 'svg' for a zip archive of one SVG per sheet
+      preview: True to leave the players' codes and ids off the cards
+      url: The site's base URL, which the codes link to
+
+    Returns:
+      generator: The document's bytes, produced as the sheets are rendered (suitable for a StreamingHttpResponse)
+    '''
+    sheets = [[(record, photo_path(record)) for record in records[start:start + CARDS_PER_SHEET]]
+              for start in range(0, len(records), CARDS_PER_SHEET)]
+    options = SheetOptions(format, preview, url, settings.ID_CARD_FONT)
+    pages = render_pages(sheets, options)
+    try:
+        if format == 'pdf':
+            yield from pdf_document(pages, len(sheets))
+        else:
+            yield from zip_archive((f"id_cards_{index + 1:03}.svg", page) for index, page in enumerate(pages))
+    finally:
+        pages.close()
@@ -0,0 +1,108 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q
+from django.db.models.functions import Lower
+from django.utils import timezone
+
+from .caching import CLAN_CACHE_NAMESPACE, bump_cache_version, invalidated_cache_seconds, versioned_key
+from .models import Clan, ClanHistoryItem, Person, clan_text_color
+from .models import get_active_game
+
+CLAN_DIRECTORY_PAGE_SIZE = 100
+CLAN_HISTORY_PAGE_SIZE = 50
+# Clan changes bump the cache version, so this only bounds how long other workers can miss them with a per-process cache
+CLAN_DIRECTORY_CACHE_SECONDS = invalidated_cache_seconds(24 * 60 * 60)
+
+
+def clan_directory():
+    '''
+    Gets a row for every clan, as plain data ready for the clan list, built with a single query
+    and cached until a clan or its membership changes.
+
+    Returns:
+      list: [{'name', 'color', 'text_color', 'thumbnail_url', 'picture_srcset', 'member_count', 'disbanded'}], ordered by name
+    '''
+    key = versioned_key(CLAN_CACHE_NAMESPACE, 'directory')
+    rows = cache.get(key)
+    if rows is None:
+        clans = Clan.objects.annotate(member_count=Count('clan_members')).order_by(Lower('name'))
+        rows = [{
+            'name': clan.name,
+            'color': clan.color,
+            'text_color': clan_text_color(clan.color),
+            'thumbnail_url': clan.thumbnail_url,
+            'picture_srcset': clan.picture_srcset,
+            'member_count': clan.member_count,
+            'disbanded': clan.disband_timestamp is not None,
+        } for clan in clans]
+        cache.set(key, rows, CLAN_DIRECTORY_CACHE_SECONDS)
+    return rows
+
+
+def disband_clan(clan, actor=None, history_item_type='d'):
+    '''
+    Disbands a clan: removes every member and its leader, and records it in the clan's history.
+    Takes the same few statements however large the clan is, all in one transaction.
+
+    Params:
+      clan: The Clan to disband
+      actor: Who disbanded it, or None if it was the system
+      history_item_type: 'd' if disbanded by `actor`, 'e' if by the system
+    '''
+    with transaction.atomic():
+        # Lock the clan so nobody can join it while it is being emptied
+        Clan.objects.select_for_update().get(pk=clan.pk)
+        Clan.objects.filter(pk=clan.pk).update(leader=None, disband_timestamp=timezone.now())
+        Person.objects.filter(clan=clan).update(clan=None)
+        ClanHistoryItem.objects.create(clan=clan, actor=actor, history_item_type=history_item_type)
+        bump_cache_version(CLAN_CACHE_NAMESPACE)
+
+
+def replace_banned_leader(player):
+    '''
+    Hands every clan led by a banned `player` to a random member who is playing this game,
+    disbanding the clans that have no such member. The player must already have been removed from their clan.
+    '''
+    with transaction.atomic():
+        led_clans = list(Clan.objects.select_for_update().filter(leader=player))
+        if not led_clans:
+            return
+        now = timezone.now()
+        history = []
+        for clan in led_clans:
+            history.append(ClanHistoryItem(clan=clan, actor=player, history_item_type='a'))
+            new_leader = Person.objects.filter(clan=clan, playerstatus__game=get_active_game(),
+                                               playerstatus__status__in=['h','v','e','z','o','x','a','m']) \
+                .exclude(pk=player.pk).order_by('?').first()
+            if new_leader is None:
+                Person.objects.filter(clan=clan).update(clan=None)
+                clan.leader = None
+                clan.disband_timestamp = now
+                history.append(ClanHistoryItem(clan=clan, history_item_type='e'))
+            else:
+                clan.leader = new_leader
+                history.append(ClanHistoryItem(clan=clan, actor=new_leader, history_item_type='b'))
+        Clan.objects.bulk_update(led_clans, ['leader', 'disband_timestamp'])
+        ClanHistoryItem.objects.bulk_create(history)
+        bump_cache_version(CLAN_CACHE_NAMESPACE)
+
+
+def clan_history_page(clan, before=None, before_id=None, page_size=CLAN_HISTORY_PAGE_SIZE):
+    '''
+    Gets one page of a clan's history, newest first, loading the people named in it with the same query.
+    Pages are found by position (the last item of the previous page) rather than by offset,
+    so even the oldest page of a long-lived clan is a quick index range scan.
+
+    Params:
+      clan: The Clan whose history to get
+      before, before_id: The timestamp and id of the last item on the previous page, or None for the first page
+      page_size: The number of items to get
+
+    Returns:
+      (list, ClanHistoryItem): The page's items, and the last of them if there are more to come (else None)
+    '''
+    items = ClanHistoryItem.objects.filter(clan=clan).select_related('actor', 'other').order_by('-timestamp', '-id')
+    if before is not None:
+        items = items.filter(Q(timestamp__lt=before) | Q(timestamp=before, id__lt=before_id))
+    items = list(items[:page_size + 1])
+    return items[:page_size], items[page_size - 1] if len(items) > page_size else None
@@ -0,0 +1,117 @@
+import base64
+import hashlib
+from io import BytesIO
+
+import segno
+from PIL import Image, ImageDraw
+from django.core.cache import cache
+from ppf.datamatrix import DataMatrix
+
+CODE_FORMATS = {'svg': 'image/svg+xml', 'png': 'image/png'}
+# {theme: (foreground, background)}. The tag page shows its code as light modules on the dark page
+CODE_THEMES = {'light': ('#000000', '#ffffff'), 'dark': ('#ffffff', None)}
+PNG_MODULE_SIZE = 10
+# Rendered codes never change, so keep them until they are evicted
+CODE_CACHE_SECONDS = 30 * 24 * 60 * 60
+
+
+def qr_modules(value, level='l'):
+    '''
+    Encodes `value` as a QR code.
+
+    Returns:
+      list: One list per row of modules, True for dark modules. There is no quiet zone around the code
+    '''
+    qr = segno.make_qr(value, error=level)
+    return [[bool(module) for module in row] for row in qr.matrix_iter(border=0)]
+
+
+def datamatrix_modules(value):
+    '''
+    Encodes `value` as a DataMatrix code, in the same form as qr_modules.
+    '''
+    return [[bool(module) for module in row] for row in DataMatrix(value).matrix]
+
+
+def modules_to_svg_path(modules, x=0, y=0, scale=1):
+    '''
+    Converts a code's modules into SVG path data, one rectangle per run of dark modules in a row.
+
+    Params:
+      modules: The modules, as returned by qr_modules
+      x, y: Where to put the top-left corner of the code
+      scale: The size of one module
+    '''
+    parts = []
+    for row_index, row in enumerate(modules):
+        column = 0
+        while column < len(row):
+            if not row[column]:
+                column += 1
+                continue
+            start = column
+            while column < len(row) and row[column]:
+                column += 1
+            width = (column - start) * scale
+            parts.append(f"M{x + start * scale} {y + row_index * scale}h{width}v{scale}h-{width}z")
+    return ''.join(parts)
+
+
+def draw_modules(draw, modules, left, top, size, fill='black'):
+    '''
+    Draws a code's modules onto a PIL ImageDraw, as large as fits in a `size` pixels square without blurring modules.
+    '''
+    scale = size // len(modules)
+    offset = (size - scale * len(modules)) // 2
+    for row_index, row in enumerate(modules):
+        for column, dark in enumerate(row):
+            if dark:
+                x, y = left + offset + column * scale, top + offset + row_index * scale
+                draw.rectangle((x, y, x + scale - 1, y + scale - 1), fill=fill)
+
+
+def render_code(kind, value, format, theme='light', level='l'):
+    '''
+    Renders a QR or DataMatrix code as an image.
+
+    Params:
+      kind: 'qr' or 'datamatrix'
+      value: The text to encode
+      format: 'svg' or 'png'
+      theme: A key of CODE_THEMES
+      level: The QR error correction level (ignored for DataMatrix codes)
+
+    Returns:
+      bytes: The encoded image
+    '''
+    modules = qr_modules(value, level) if kind == 'qr' else datamatrix_modules(value)
+    foreground, background = CODE_THEMES[theme]
+    width, height = len(modules[0]), len(modules)
+    if format == 'svg':
+        background_rect = f'<rect width="{width}" height="{height}" fill="{background}"/>' if background else ''
+        return (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width} {height}" shape-rendering="crispEdges">'
+                f'{background_rect}<path fill="{foreground}" d="{modules_to_svg_path(modules)}"/></svg>').encode()
+    size = max(width, height) * PNG_MODULE_SIZE
+    im = Image.new('RGBA', (width * PNG_MODULE_SIZE, height * PNG_MODULE_SIZE), background or (0, 0, 0, 0))
+    draw_modules(ImageDraw.Draw(im), modules, 0, 0, size, fill=foreground)
+    output = BytesIO()
+    im.save(output, format='PNG', optimize=True)
+    return output.getvalue()
+
+
+def code_data_uri(kind, value, format, theme='light', level='l'):
+    '''
+    Renders a QR or DataMatrix code as a data: URI, to be put straight into the page.
+    Codes usually encode secret tag ids, so they must never travel in a request URL, where access logs would record them.
+    Rendered images are cached, keyed by a hash of everything that goes into them.
+
+    Params:
+      See render_code
+    '''
+    digest = hashlib.sha256(f"{kind}:{format}:{theme}:{level}:{value}".encode()).hexdigest()
+    cache_key = f"code:{digest}"
+    image = cache.get(cache_key)
+    if image is None:
+        image = render_code(kind, value, format, theme, level)
+        cache.set(cache_key, image, CODE_CACHE_SECONDS)
+    return f"data:{CODE_FORMATS[format]};base64,{base64.b64encode(image).decode()}"
@@ -1,5 +1,5 @@
-from hvz.models import Announcement
+from hvz.announcements import get_active_announcements
 
 def get_announcements(request):
-   announcements = Announcement.objects.filter(active=True).order_by('-post_time')
-   return {'announcements': announcements}
\ No newline at end of file
+   announcements, banner = get_active_announcements()
+   return {'announcements': announcements, 'announcement_banner': banner}
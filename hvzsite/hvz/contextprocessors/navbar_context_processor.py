@@ -0,0 +1,11 @@
+from django.utils.functional import SimpleLazyObject
+
+from hvz.navbar import NAVBAR_CACHE_SECONDS, navbar_cache_version, navbar_role
+
+def get_navbar(request):
+   # Both are only looked up if the page has a navbar
+   return {
+      'navbar_role': SimpleLazyObject(lambda: navbar_role(request.user)),
+      'navbar_version': SimpleLazyObject(navbar_cache_version),
+      'navbar_cache_seconds': NAVBAR_CACHE_SECONDS
+   }
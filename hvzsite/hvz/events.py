@@ -0,0 +1,88 @@
+import datetime
+import threading
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+EVENTS_PAGE_SIZE = 200
+# Longest a request may wait for new events. Each waiting request holds a worker, so keep this short
+EVENTS_MAX_WAIT_SECONDS = 25
+# How often a waiting request checks the cached id of the game's newest event
+EVENTS_POLL_SECONDS = 0.5
+# How often a waiting request checks the database anyway, in case the cache is not shared with the worker that recorded the event
+EVENTS_RECHECK_SECONDS = 5
+# Each waiting request holds a worker thread and its database connection, so only so many may wait at once per process
+_waiting = threading.BoundedSemaphore(settings.EVENTS_MAX_WAITING)
+
+
+def latest_event_key(game_id):
+    return f"latest_event:{game_id}"
+
+
+def record_event(game_id, kind, player_id=None, other_id=None, data=None):
+    '''
+    Adds an event to a game's feed, and lets requests waiting on the feed know once the transaction commits.
+
+    Params:
+      game_id: The id of the Game it happened in, or None to record nothing
+      kind: One of GameEvent's kinds
+      player_id: The id of the Person it happened to or was done by
+      other_id: The id of the other Person involved, if any (e.g. the player who was tagged)
+      data: Anything else worth knowing about it, as JSON-serializable data
+    '''
+    if game_id is None:
+        return
+    GameEvent = apps.get_model('hvz', 'GameEvent')
+    event = GameEvent.objects.create(game_id=game_id, kind=kind, player_id=player_id, other_id=other_id, data=data or {})
+    transaction.on_commit(lambda: cache.set(latest_event_key(game_id), event.id, None))
+
+
+def events_since(game, since, limit=EVENTS_PAGE_SIZE):
+    '''
+    Gets a game's settled events after the one with id `since`, oldest first.
+    Event ids only ever increase, so a client that passes the id of the last event it saw gets exactly what is new.
+    Ids are handed out when events are inserted but only become visible when their transaction commits, so a later event
+    can show up first. Events are only served once they are settings.FEED_SETTLE_SECONDS old, so the cursor never passes
+    one still being committed.
+    '''
+    GameEvent = apps.get_model('hvz', 'GameEvent')
+    settled = timezone.now() - datetime.timedelta(seconds=settings.FEED_SETTLE_SECONDS)
+    return list(GameEvent.objects.filter(game=game, id__gt=since, timestamp__lt=settled)
+                .select_related('player', 'other').order_by('id')[:limit])
+
+
+def wait_for_events(game, since, timeout, limit=EVENTS_PAGE_SIZE):
+    '''
+    Long-polls a game's feed: gets the events after `since`, waiting up to `timeout` seconds for some to happen
+    if there are none yet. While waiting, only the cache is checked, except every EVENTS_RECHECK_SECONDS.
+    If settings.EVENTS_MAX_WAITING requests are already waiting in this process, returns at once instead of waiting.
+
+    Returns:
+      list: The events after `since`, empty if none happened in time
+    '''
+    events = events_since(game, since, limit)
+    if events or timeout <= 0 or not _waiting.acquire(blocking=False):
+        return events
+    try:
+        deadline = time.monotonic() + timeout
+        next_check = time.monotonic() + EVENTS_RECHECK_SECONDS
+        latest_seen = since
+        while True:
+            now = time.monotonic()
+            latest = cache.get(latest_event_key(game.id)) or 0
+            if latest > latest_seen:
+                # Something new was recorded: look once it has settled
+                latest_seen = latest
+                next_check = min(next_check, now + settings.FEED_SETTLE_SECONDS)
+            if now >= next_check or now >= deadline:
+                events = events_since(game, since, limit)
+                if events or now >= deadline:
+                    return events
+                next_check = now + EVENTS_RECHECK_SECONDS
+            time.sleep(EVENTS_POLL_SECONDS)
+    finally:
+        _waiting.release()
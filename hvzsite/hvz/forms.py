@@ -299,15 +299,41 @@ class PostGameSurveyForm(forms.ModelForm):
                 yield (self[field_name], self[opposite_field])
 
 
+class MultipleImageInput(forms.FileInput):
+    allow_multiple_selected = True
+
+    def __init__(self, attrs=None):
+        super().__init__({"multiple": True, "accept": "image/*", **(attrs or {})})
+
+    def value_from_datadict(self, data, files, name):
+        return files.getlist(name)
+
+class MultipleImageField(forms.ImageField):
+    '''
+    An image field that accepts several files at once. Cleans to a (possibly empty) list of images.
+    '''
+    def __init__(self, *args, max_files=None, **kwargs):
+        kwargs.setdefault("widget", MultipleImageInput())
+        self.max_files = max_files
+        super().__init__(*args, **kwargs)
+
+    def clean(self, data, initial=None):
+        if not data:
+            return super().clean(None, initial) or []
+        if self.max_files is not None and len(data) > self.max_files:
+            raise ValidationError(_("You can attach at most %(max)d images."), code="max_files", params={"max": self.max_files})
+        return [super(MultipleImageField, self).clean(file, initial) for file in data]
+
 class ReportForm(forms.ModelForm):
+    attachments = MultipleImageField(required=False, max_files=5, label="Pictures (optional)")
+
     class Meta:
         model = Report
-        fields = ["report_text", "reporter_email", "picture"]
+        fields = ["report_text", "reporter_email"]
     
     def __init__(self, *args, **kwargs):
         authenticated = kwargs.pop("authenticated", None)
         super().__init__(*args, **kwargs)
-        self.fields['picture'].required = False
         self.fields['report_text'].widget.attrs['cols'] = 80
         if authenticated:
             self.fields.pop("reporter_email")
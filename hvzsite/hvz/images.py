@@ -0,0 +1,265 @@
+import base64
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+
+from PIL import ExifTags, Image, ImageOps
+from django.apps import apps
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.dispatch import Signal
+
+logger = logging.getLogger(__name__)
+
+FORMAT_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp'}
+FORMAT_OPTIONS = {
+    'PNG': {'optimize': True},
+    'JPEG': {'quality': 95, 'optimize': True, 'progressive': True},
+    'WEBP': {'quality': 80},
+}
+
+DATA_URL_PREFIX = 'data:image/jpeg;base64,'
+# Decoded uploads larger than this spill from memory to a temporary file
+SPOOL_MAX_MEMORY = 256 * 1024
+# Base64 characters decoded at a time. A multiple of 4, so every chunk decodes on its own
+BASE64_CHUNK_SIZE = 64 * 1024
+# JPEG segments that only carry metadata: APP1 (EXIF, XMP) and APP3-APP15 except APP14 (Adobe colour transform), and comments.
+# APP0 (JFIF) and APP2 (ICC colour profile) affect how the image is displayed, so they are kept
+JPEG_METADATA_MARKERS = {0xE1, *range(0xE3, 0xEE), 0xEF, 0xFE}
+JPEG_START_OF_SCAN = 0xDA
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending_jobs = set()
+
+# Sent (with the model as sender and the record's `pk`) once a record's new derivatives are published
+picture_processed = Signal()
+
+
+def get_executor():
+    '''
+    Gets the worker pool used for picture processing and ID card sheets, creating it on first use.
+
+    PIL releases the GIL while resampling and encoding, so a thread pool is enough
+    to spread a burst of uploads across all cores.
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.IMAGE_PROCESSING_WORKERS, thread_name_prefix="hvz-images")
+    return _executor
+
+
+def derivative_name(original_name, key, format, data):
+    '''
+    Gets the storage name of a derivative, kept next to the original so it is served
+    (and access controlled) exactly like the original. The name carries a hash of the
+    derivative's content, so a given URL always refers to the same bytes and can be cached forever.
+    '''
+    stem = os.path.splitext(original_name)[0]
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    return f"{stem}.{key}.{digest}.{FORMAT_EXTENSIONS[format]}"
+
+
+def render_derivatives(source, sizes):
+    '''
+    Renders every derivative of an image.
+
+    Params:
+      source: A path or file-like object containing the original image
+      sizes: A dict of {key: (width, height, format)}
+
+    Returns:
+      dict: {key: encoded image bytes}
+    '''
+    largest = max(max(width, height) for width, height, format in sizes.values())
+    with Image.open(source) as im:
+        # JPEGs can be decoded straight to 1/2, 1/4 or 1/8 scale, which is much cheaper than decoding
+        # every pixel of a large photo only to throw most of them away. No-op for other formats
+        im.draft('RGB', (largest, largest))
+        im = ImageOps.exif_transpose(im).convert('RGB')
+    rendered = {}
+    # Work from the largest size down so each thumbnail resamples the previous one instead of the original
+    for key, (width, height, format) in sorted(sizes.items(), key=lambda item: item[1][0] * item[1][1], reverse=True):
+        im.thumbnail((width, height), Image.Resampling.LANCZOS)
+        output = BytesIO()
+        im.save(output, format=format, **FORMAT_OPTIONS[format])
+        rendered[key] = output.getvalue()
+    return rendered
+
+
+def process_picture(model_label, pk, original_name):
+    '''
+    Generates and stores the derivatives of one record's picture, then publishes them on the record.
+    The record is only updated if it still points at the same original, so a stale job can never
+    overwrite the derivatives of a newer upload.
+    '''
+    try:
+        model = apps.get_model(model_label)
+        with default_storage.open(original_name, 'rb') as f:
+            rendered = render_derivatives(f, model.picture_sizes)
+        derivatives = {}
+        for key, data in rendered.items():
+            name = derivative_name(original_name, key, model.picture_sizes[key][2], data)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+            derivatives[key] = default_storage.save(name, ContentFile(data))
+        if model.objects.filter(pk=pk, picture=original_name).update(picture_derivatives=derivatives):
+            picture_processed.send(sender=model, pk=pk)
+    except Exception:
+        logger.exception(f"Failed to process picture {original_name} for {model_label} {pk}")
+    finally:
+        with _executor_lock:
+            _pending_jobs.discard((model_label, pk, original_name))
+        close_old_connections()
+
+
+def queue_picture_processing(instance):
+    '''
+    Queues derivative generation for a freshly saved picture. The job is submitted once the
+    surrounding transaction commits so the worker always sees the saved record.
+    '''
+    job = (instance._meta.label, instance.pk, instance.picture.name)
+
+    def submit():
+        with _executor_lock:
+            if job in _pending_jobs:
+                return
+            _pending_jobs.add(job)
+        get_executor().submit(process_picture, *job)
+
+    transaction.on_commit(submit)
+
+
+def decode_data_url(data_url, max_size):
+    '''
+    Decodes a base64 JPEG data URL (as posted by the webcam capture) into a temporary file,
+    a chunk at a time, so the decoded image is never held in memory next to the encoded one.
+
+    Raises:
+      ValueError: If `data_url` is not a JPEG data URL, or would decode to more than `max_size` bytes
+    '''
+    if not data_url.startswith(DATA_URL_PREFIX):
+        raise ValueError("Photo must be a JPEG data URL")
+    if (len(data_url) - len(DATA_URL_PREFIX)) // 4 * 3 > max_size:
+        raise ValueError(f"Photo is larger than {max_size // 1024} KB")
+    decoded = SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    for start in range(len(DATA_URL_PREFIX), len(data_url), BASE64_CHUNK_SIZE):
+        # Form encoding turns '+' into ' ', so put them back
+        decoded.write(base64.b64decode(data_url[start:start + BASE64_CHUNK_SIZE].replace(' ', '+'), validate=True))
+    decoded.seek(0)
+    return decoded
+
+
+def strip_jpeg_metadata(source):
+    '''
+    Copies a JPEG without its metadata segments (EXIF can carry GPS positions and device details).
+    Only the segment headers are parsed: the compressed image data is copied as-is, without decoding it.
+
+    Raises:
+      ValueError: If `source` is not a JPEG
+    '''
+    if source.read(2) != b'\xff\xd8':
+        raise ValueError("Photo is not a JPEG")
+    stripped = SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    stripped.write(b'\xff\xd8')
+    while True:
+        header = source.read(4)
+        length = int.from_bytes(header[2:], 'big')
+        if len(header) < 4 or header[0] != 0xFF or length < 2:
+            raise ValueError("Photo is not a valid JPEG")
+        if header[1] == JPEG_START_OF_SCAN:
+            # Everything from here on is image data
+            stripped.write(header)
+            shutil.copyfileobj(source, stripped)
+            break
+        segment = source.read(length - 2)
+        if header[1] not in JPEG_METADATA_MARKERS:
+            stripped.write(header)
+            stripped.write(segment)
+    stripped.seek(0)
+    return stripped
+
+
+def ingest_webcam_photo(data_url, name):
+    '''
+    Turns a photo posted as a JPEG data URL into a file that can be assigned to a picture field.
+
+    The request thread only decodes the base64 and drops the photo's metadata. Resizing and encoding
+    are left to the derivative pipeline, which works off the request thread once the record is saved.
+
+    Params:
+      data_url: The posted data URL
+      name: The file name to store the photo under
+
+    Raises:
+      ValueError: If the photo is too large or is not a JPEG
+    '''
+    with decode_data_url(data_url, settings.WEBCAM_PHOTO_MAX_SIZE) as decoded:
+        stripped = strip_jpeg_metadata(decoded)
+    # Read the header (not the pixels) to make sure this really is an image PIL can process later
+    with Image.open(stripped) as im:
+        if im.format != 'JPEG':
+            raise ValueError("Photo is not a JPEG")
+    stripped.seek(0)
+    return File(stripped, name=name)
+
+
+def read_picture_file(path, member):
+    if member is None:
+        with open(path, "rb") as f:
+            return f.read()
+    with zipfile.ZipFile(path) as archive:
+        return archive.read(member)
+
+
+def render_picture_file(path, member, sizes, recompress):
+    '''
+    Does the CPU-heavy part of importing or recompressing one picture file (see the import_pictures command).
+    Meant to run in a worker process, so it must not touch the database or storage.
+
+    Params:
+      path: The file to read, or the zip archive containing it
+      member: The name of the file inside the archive at `path`, or None for a plain file
+      sizes: The `picture_sizes` of the model the picture belongs to
+      recompress: If True, re-encode opaque PNG originals as JPEG (photos compress far better that way)
+
+    Returns:
+      (bytes, str, dict): The original to store (None to keep the current one), its extension, and {key: derivative bytes}
+    '''
+    data = read_picture_file(path, member)
+    original, extension = None, os.path.splitext(member or path)[1].lower()
+    with Image.open(BytesIO(data)) as im:
+        format = im.format
+        orientation = im.getexif().get(ExifTags.Base.Orientation, 1)
+        opaque = im.mode in ("RGB", "L") or (im.mode == "RGBA" and im.getchannel("A").getextrema()[0] == 255)
+        if recompress and format == "PNG" and opaque:
+            output = BytesIO()
+            im.convert("RGB").save(output, format="JPEG", **FORMAT_OPTIONS["JPEG"])
+            if output.tell() < len(data):
+                original, extension = output.getvalue(), ".jpg"
+    if not recompress:
+        original = data
+        if format == "JPEG" and orientation != 1:
+            # Stripping the metadata below would drop the Orientation tag with it, so turn the photo upright first.
+            # Re-encoding leaves out all of the metadata anyway
+            with Image.open(BytesIO(data)) as im:
+                icc_profile = im.info.get("icc_profile")
+                upright = ImageOps.exif_transpose(im).convert("RGB")
+            output = BytesIO()
+            upright.save(output, format="JPEG", icc_profile=icc_profile, **FORMAT_OPTIONS["JPEG"])
+            original = output.getvalue()
+        elif format == "JPEG":
+            # Photo dumps come straight off cameras and phones, which record where the photo was taken
+            original = strip_jpeg_metadata(BytesIO(data)).read()
+    # Derivatives are rendered from the file as read, so they are turned upright by its own Orientation tag
+    return original, extension, render_derivatives(BytesIO(data), sizes)
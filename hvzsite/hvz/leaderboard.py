@@ -0,0 +1,164 @@
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, DateTimeField, DurationField, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum, Value
+from django.utils import timezone
+
+from .caching import CLAN_CACHE_NAMESPACE, bump_cache_version, get_cache_version, versioned_key
+
+LEADERBOARD_CACHE_NAMESPACE = 'clan_leaderboard'
+# Tags update the cached leaderboard in place, and two updates racing each other can lose one.
+# Rebuilding every so often puts right anything that drifted
+LEADERBOARD_CACHE_SECONDS = 10 * 60
+HUMAN_STATUSES = ['h', 'v', 'e']
+ZOMBIE_STATUSES = ['z', 'x', 'o']
+# Players who were tagged, so their survival ended with their first tag (OZs never survived at all)
+TURNED_STATUSES = ['z', 'x']
+
+
+def leaderboard_key(game):
+    # Membership changes bump the clan namespace, so they invalidate the leaderboard too
+    return versioned_key(LEADERBOARD_CACHE_NAMESPACE, get_cache_version(CLAN_CACHE_NAMESPACE), game.id)
+
+
+def survival_reference(game):
+    '''
+    Gets the time survival is measured up to: now, or the end of the game once it is over.
+    '''
+    return min(timezone.now(), game.end_date)
+
+
+def build_leaderboard(game):
+    '''
+    Aggregates each active clan's performance in a game with two grouped queries.
+
+    Survival is kept as totals rather than averages so single tags can be applied to it (see record_turned).
+    Players still alive keep surviving, so their total is measured up to `reference` and moved forward when it is read.
+
+    Returns:
+      dict: {'reference': timestamp, 'clans': {clan id: {'name', 'color', 'tags', 'humans', 'zombies',
+             'survived_seconds', 'survived_count', 'alive_seconds', 'alive_count'}}}
+    '''
+    PlayerStatus = apps.get_model('hvz', 'PlayerStatus')
+    Tag = apps.get_model('hvz', 'Tag')
+    reference = survival_reference(game)
+    first_tagged = Tag.objects.filter(game=game, taggee=OuterRef('player')).order_by('timestamp').values('timestamp')[:1]
+    turned = Q(status__in=TURNED_STATUSES, turned_at__isnull=False, activation_timestamp__isnull=False)
+    alive = Q(status__in=HUMAN_STATUSES, activation_timestamp__isnull=False)
+    statuses = PlayerStatus.objects.filter(game=game, player__clan__isnull=False, player__clan__disband_timestamp__isnull=True) \
+        .annotate(turned_at=Subquery(first_tagged)) \
+        .values('player__clan', 'player__clan__name', 'player__clan__color') \
+        .annotate(
+            humans=Count('id', filter=Q(status__in=HUMAN_STATUSES)),
+            zombies=Count('id', filter=Q(status__in=ZOMBIE_STATUSES)),
+            survived=Sum(ExpressionWrapper(F('turned_at') - F('activation_timestamp'), output_field=DurationField()), filter=turned),
+            survived_count=Count('id', filter=turned),
+            alive=Sum(ExpressionWrapper(Value(reference, output_field=DateTimeField()) - F('activation_timestamp'), output_field=DurationField()), filter=alive),
+            alive_count=Count('id', filter=alive),
+        )
+    clans = {}
+    for row in statuses:
+        clans[str(row['player__clan'])] = {
+            'name': row['player__clan__name'],
+            'color': row['player__clan__color'],
+            'tags': 0,
+            'humans': row['humans'],
+            'zombies': row['zombies'],
+            'survived_seconds': row['survived'].total_seconds() if row['survived'] else 0,
+            'survived_count': row['survived_count'],
+            'alive_seconds': row['alive'].total_seconds() if row['alive'] else 0,
+            'alive_count': row['alive_count'],
+        }
+    tags = Tag.objects.filter(game=game, tagger__clan__isnull=False).values('tagger__clan').annotate(tags=Count('id'))
+    for row in tags:
+        if str(row['tagger__clan']) in clans:
+            clans[str(row['tagger__clan'])]['tags'] = row['tags']
+    return {'reference': reference.timestamp(), 'clans': clans}
+
+
+def get_leaderboard(game):
+    '''
+    Gets the clan leaderboard of a game, best taggers first (cached; see build_leaderboard).
+
+    Returns:
+      list: [{'name', 'color', 'tags', 'humans', 'zombies', 'average_survival_hours'}]
+    '''
+    if game is None:
+        return []
+    key = leaderboard_key(game)
+    board = cache.get(key)
+    if board is None:
+        board = build_leaderboard(game)
+        cache.set(key, board, LEADERBOARD_CACHE_SECONDS)
+    elapsed = survival_reference(game).timestamp() - board['reference']
+    rows = []
+    for clan in board['clans'].values():
+        survivors = clan['survived_count'] + clan['alive_count']
+        total = clan['survived_seconds'] + clan['alive_seconds'] + clan['alive_count'] * elapsed
+        rows.append({
+            'name': clan['name'],
+            'color': clan['color'],
+            'tags': clan['tags'],
+            'humans': clan['humans'],
+            'zombies': clan['zombies'],
+            'average_survival_hours': round(total / survivors / 3600, 1) if survivors else None,
+        })
+    rows.sort(key=lambda row: (-row['tags'], -row['humans'], row['name'].lower()))
+    return rows
+
+
+def update_leaderboard(game, clan_id, update):
+    '''
+    Applies `update` to one clan's entry of a cached leaderboard once the surrounding transaction commits.
+    If the clan has no entry yet the leaderboard is rebuilt on its next read instead.
+    '''
+    def apply():
+        key = leaderboard_key(game)
+        board = cache.get(key)
+        if board is None:
+            return
+        if clan_id is None or str(clan_id) not in board['clans']:
+            bump_cache_version(LEADERBOARD_CACHE_NAMESPACE)
+            return
+        update(board, board['clans'][str(clan_id)])
+        cache.set(key, board, LEADERBOARD_CACHE_SECONDS)
+
+    transaction.on_commit(apply)
+
+
+def record_tag(tag):
+    '''
+    Counts a new tag towards its tagger's clan.
+    '''
+    if tag.game is None or tag.tagger.clan_id is None:
+        return
+
+    def update(board, clan):
+        clan['tags'] += 1
+
+    update_leaderboard(tag.game, tag.tagger.clan_id, update)
+
+
+def record_turned(status):
+    '''
+    Moves a player who was just tagged from their clan's humans to its zombies, ending their survival now.
+    '''
+    if status.player.clan_id is None:
+        return
+    activated = status.activation_timestamp.timestamp() if status.activation_timestamp else None
+    turned = timezone.now().timestamp()
+
+    def update(board, clan):
+        clan['humans'] -= 1
+        clan['zombies'] += 1
+        if activated is not None:
+            clan['alive_seconds'] -= board['reference'] - activated
+            clan['alive_count'] -= 1
+            clan['survived_seconds'] += turned - activated
+            clan['survived_count'] += 1
+
+    update_leaderboard(status.game, status.player.clan_id, update)
+
+
+def invalidate_leaderboard():
+    bump_cache_version(LEADERBOARD_CACHE_NAMESPACE)
@@ -0,0 +1,168 @@
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from hvz.images import derivative_name, render_picture_file
+from hvz.models import BadgeType, Blaster, Clan, Person, Report, ReportAttachment
+from hvz.sprites import build_badge_sprite
+
+# Pictures that can be imported from files named after their records
+IMPORT_MODELS = {"person": Person, "clan": Clan, "blaster": Blaster}
+# Every model with a picture, all of which can be recompressed
+MODELS = {**IMPORT_MODELS, "badge": BadgeType, "report": Report, "report_attachment": ReportAttachment}
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp")
+
+
+class Command(BaseCommand):
+    help = "Imports pictures from a directory or zip file (matched to records by file name), or recompresses existing pictures, using every core."
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", nargs="?", help="Directory or zip file to import pictures from. "
+                                                      "Files are matched by name: players by email, email username or player UUID, "
+                                                      "clans by name, blasters by id")
+        parser.add_argument("--model", choices=MODELS.keys(), action="append",
+                            help="What the pictures belong to. Required when importing (person, clan or blaster); "
+                                 "recompresses all of them by default")
+        parser.add_argument("--recompress", action="store_true", help="Re-encode the pictures already in the media library instead of importing")
+        parser.add_argument("--dry-run", action="store_true", help="Do all the processing and report the results, but do not store anything")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes (defaults to one per core)")
+        parser.add_argument("--state", help="File recording finished pictures. If given, a rerun skips everything listed in it")
+
+    def handle(self, *args, **options):
+        if options["recompress"] == (options["source"] is not None):
+            raise CommandError("Give either a source to import from, or --recompress")
+        if options["source"] is not None and (options["model"] is None or len(options["model"]) != 1):
+            raise CommandError("Give exactly one --model to import pictures for")
+        if options["source"] is not None and options["model"][0] not in IMPORT_MODELS:
+            raise CommandError(f"Pictures can only be imported for: {', '.join(IMPORT_MODELS)}")
+        models = [MODELS[name] for name in options["model"] or MODELS]
+
+        jobs = self.find_recompress_jobs(models) if options["recompress"] else self.find_import_jobs(models[0], options["source"])
+        done = set()
+        if options["state"] and os.path.exists(options["state"]):
+            with open(options["state"]) as f:
+                done = set(f.read().splitlines())
+        jobs = [job for job in jobs if job[0] not in done]
+        self.stdout.write(f"{len(jobs)} pictures to process ({len(done)} already done)")
+
+        state = open(options["state"], "a") if options["state"] and not options["dry_run"] else None
+        bytes_before = bytes_after = failed = 0
+        try:
+            with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+                futures = {executor.submit(render_picture_file, path, member, model.picture_sizes, options["recompress"]): (key, model, pk, path, member)
+                           for key, model, pk, path, member in jobs}
+                for future in as_completed(futures):
+                    key, model, pk, path, member = futures[future]
+                    try:
+                        before, after = self.store(model, pk, path, member, *future.result(), options["recompress"], options["dry_run"])
+                    except Exception as e:
+                        failed += 1
+                        self.stderr.write(f"Failed to process {member or path} for {model.__name__} {pk}: {e}")
+                        continue
+                    bytes_before += before
+                    bytes_after += after
+                    if state is not None:
+                        state.write(key + "\n")
+                        state.flush()
+        finally:
+            if state is not None:
+                state.close()
+        if BadgeType in models and options["recompress"] and not options["dry_run"]:
+            build_badge_sprite()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Would process' if options['dry_run'] else 'Processed'} {len(jobs) - failed} pictures ({failed} failed). "
+            f"{bytes_before} bytes before, {bytes_after} bytes after: {bytes_before - bytes_after} bytes saved"))
+
+    def find_import_jobs(self, model, source):
+        '''
+        Lists the image files in `source` and matches each to a record of `model`.
+
+        Returns:
+          list: [(state key, model, pk, path, zip member or None)]
+        '''
+        if zipfile.is_zipfile(source):
+            with zipfile.ZipFile(source) as archive:
+                files = [(source, member) for member in archive.namelist() if member.lower().endswith(IMAGE_EXTENSIONS)]
+        elif os.path.isdir(source):
+            files = [(os.path.join(root, name), None) for root, dirs, names in os.walk(source)
+                     for name in names if name.lower().endswith(IMAGE_EXTENSIONS)]
+        else:
+            raise CommandError(f"{source} is neither a directory nor a zip file")
+
+        lookup = self.build_lookup(model)
+        jobs = []
+        for path, member in files:
+            stem = os.path.splitext(os.path.basename(member or path))[0].lower()
+            pk = lookup.get(stem)
+            if pk is None:
+                self.stderr.write(f"No {model.__name__} matches {member or path}")
+                continue
+            jobs.append((f"import:{model._meta.label}:{pk}:{member or path}", model, pk, path, member))
+        return jobs
+
+    def build_lookup(self, model):
+        '''
+        Gets {lower-case file name stem: pk} for every name a picture of a `model` record may be filed under.
+        '''
+        if model is Clan:
+            return {name.lower(): pk for pk, name in Clan.objects.values_list("pk", "name")}
+        if model is Blaster:
+            return {str(pk): pk for pk in Blaster.objects.values_list("pk", flat=True)}
+        lookup, usernames = {}, {}
+        for pk, player_uuid, email in Person.objects.values_list("pk", "player_uuid", "email"):
+            lookup[str(player_uuid)] = pk
+            lookup[email.lower()] = pk
+            usernames.setdefault(email.split("@")[0].lower(), []).append(pk)
+        # A username shared by accounts on different domains could be either of them, so it matches neither
+        lookup.update({username: pks[0] for username, pks in usernames.items() if len(pks) == 1 and username not in lookup})
+        return lookup
+
+    def find_recompress_jobs(self, models):
+        jobs = []
+        for model in models:
+            for pk, picture in model.objects.exclude(picture__isnull=True).exclude(picture="").values_list("pk", "picture"):
+                # Not keyed on the picture's name, which changes when a PNG is re-encoded as a JPEG
+                jobs.append((f"recompress:{model._meta.label}:{pk}", model, pk, default_storage.path(picture), None))
+        return jobs
+
+    def store(self, model, pk, path, member, original, extension, rendered, recompress, dry_run):
+        '''
+        Stores the results of one job and publishes them on the record, bypassing the model's save() hook
+        since the derivatives are already rendered.
+
+        Returns:
+          (int, int): Bytes used by the record's pictures before and after
+        '''
+        record = model.objects.get(pk=pk)
+        old_names = [record.picture.name, *record.picture_derivatives.values()] if record.picture else []
+        bytes_before = sum(default_storage.size(name) for name in old_names if default_storage.exists(name))
+        if original is None:
+            name = record.picture.name
+            bytes_after = default_storage.size(name)
+        else:
+            if recompress:
+                name = os.path.splitext(record.picture.name)[0] + extension
+            else:
+                name = record.picture.field.generate_filename(record, os.path.basename(member or path))
+            bytes_after = len(original)
+        bytes_after += sum(len(data) for data in rendered.values())
+        if dry_run:
+            return bytes_before, bytes_after
+
+        if original is not None:
+            name = default_storage.save(name, ContentFile(original))
+        derivatives = {}
+        for key, data in rendered.items():
+            derivatives[key] = derivative_name(name, key, model.picture_sizes[key][2], data)
+            if not default_storage.exists(derivatives[key]):
+                default_storage.save(derivatives[key], ContentFile(data))
+        model.objects.filter(pk=pk).update(picture=name, picture_derivatives=derivatives)
+        for old_name in set(old_names) - {name, *derivatives.values()}:
+            if recompress or old_name != record.picture.name:
+                default_storage.delete(old_name)
+        return bytes_before, bytes_after
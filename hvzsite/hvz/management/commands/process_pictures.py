@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from hvz.images import get_executor, process_picture
+from hvz.models import BadgeType, Blaster, Clan, Person, Report, ReportAttachment
+from hvz.sprites import build_badge_sprite
+
+
+class Command(BaseCommand):
+    help = "Generates the resized derivatives of every picture that does not have them yet (e.g. pictures uploaded before derivatives existed)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Regenerate derivatives even for pictures that already have them")
+
+    def handle(self, *args, **options):
+        futures = []
+        for model in (Person, Clan, Blaster, BadgeType, Report, ReportAttachment):
+            records = model.objects.exclude(picture__isnull=True).exclude(picture="")
+            if not options["all"]:
+                records = records.filter(picture_derivatives={})
+            for pk, picture in records.values_list("pk", "picture"):
+                futures.append(get_executor().submit(process_picture, model._meta.label, pk, picture))
+        for future in futures:
+            future.result()
+        build_badge_sprite()
+        self.stdout.write(self.style.SUCCESS(f"Processed {len(futures)} pictures"))
@@ -0,0 +1,174 @@
+import base64
+import mimetypes
+import os
+import time
+import uuid
+from urllib.parse import quote
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import FileResponse, Http404, HttpResponse
+from django.templatetags.static import static
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import http_date
+
+PICTURE_PRIVACY_CACHE_SECONDS = 300
+
+
+def picture_is_public(player_uuid):
+    '''
+    Checks whether a player's real picture may be shown to anonymous visitors (only admins' pictures are).
+    The answer is cached, so a page full of pictures costs at most one query per player.
+    '''
+    cache_key = f"picture_public:{player_uuid}"
+    public = cache.get(cache_key)
+    if public is None:
+        Person = apps.get_model('hvz', 'Person')
+        public = Person.objects.filter(player_uuid=player_uuid) \
+                               .filter(Q(is_superuser=True) |
+                                       Q(playerstatus__status='a', playerstatus__game__currentgame__isnull=False)) \
+                               .exists()
+        cache.set(cache_key, public, PICTURE_PRIVACY_CACHE_SECONDS)
+    return public
+
+
+def serve_file(request, path, max_age=3600, private=False, immutable=False):
+    '''
+    Serves a file from disk with ETag/Last-Modified validators, answering conditional requests with a 304.
+
+    The body is streamed with a FileResponse, or handed off to the front-end server with
+    X-Accel-Redirect (nginx) / X-Sendfile (apache, lighttpd) if MEDIA_SENDFILE is configured.
+
+    Params:
+      request: The request being answered
+      path: The absolute path of the file to serve
+      max_age: How long (in seconds) clients may reuse the file without revalidating
+      private: True if the response depends on who is asking and must not be stored by shared caches
+      immutable: True if the URL always refers to the same bytes, so clients need not revalidate even on reload
+    '''
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404()
+    if not os.path.isfile(path):
+        raise Http404()
+
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    last_modified = int(stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        media_root = os.path.join(os.path.abspath(settings.MEDIA_ROOT), '')
+        if settings.MEDIA_SENDFILE == 'x-accel-redirect' and path.startswith(media_root):
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + path[len(media_root):].replace(os.sep, '/')
+        elif settings.MEDIA_SENDFILE == 'x-sendfile':
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = path
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+        response['Last-Modified'] = http_date(last_modified)
+    response['ETag'] = etag
+    if private:
+        patch_cache_control(response, private=True, max_age=max_age)
+    else:
+        patch_cache_control(response, public=True, max_age=max_age)
+    if immutable:
+        patch_cache_control(response, immutable=True)
+    return response
+
+
+def serve_profile_picture(request, player_uuid, fname):
+    '''
+    Serves a profile picture (or one of its derivatives), substituting the placeholder for
+    visitors that may not see it. Since the same URL can answer with either file, responses vary on the session cookie.
+    '''
+    try:
+        player_uuid = str(uuid.UUID(player_uuid))
+    except ValueError:
+        raise Http404()
+    if request.user.is_authenticated or picture_is_public(player_uuid):
+        path = os.path.join(os.path.abspath(settings.MEDIA_ROOT), 'profile_pictures', player_uuid, fname)
+    else:
+        path = os.path.join(settings.STATIC_ROOT, 'images', 'noprofile.png')
+    response = serve_file(request, path, private=True)
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+
+def sign_media_name(name, expires):
+    '''
+    Computes the signature that grants access to the media file `name` until the unix time `expires`.
+    '''
+    mac = salted_hmac('hvz.media.signed_url', f"{name}:{expires}", algorithm='sha256').digest()
+    return base64.urlsafe_b64encode(mac[:18]).decode()
+
+
+def signed_media_url(name):
+    '''
+    Gets a URL that serves the media file `name` without any per-request permission check.
+    Only hand these out to viewers that are allowed to see the file.
+
+    The expiry is rounded up to a whole SIGNED_MEDIA_URL_LIFETIME, so every page rendered within the same
+    window links the same URL and browsers reuse their cached copy instead of downloading it again.
+    '''
+    lifetime = settings.SIGNED_MEDIA_URL_LIFETIME
+    expires = (int(time.time()) // lifetime + 2) * lifetime
+    return f"{settings.MEDIA_URL}signed/{expires}/{sign_media_name(name, expires)}/{quote(name)}"
+
+
+def serve_signed_media(request, expires, signature, name):
+    '''
+    Serves a media file through a signed URL from signed_media_url. Checking the signature is a pure
+    computation, so these requests never touch the database or the session.
+    Derivative names carry a hash of their content, so the response can be cached until the URL expires.
+    '''
+    expires = int(expires)
+    remaining = expires - int(time.time())
+    if remaining <= 0 or not constant_time_compare(signature, sign_media_name(name, expires)):
+        raise Http404()
+    try:
+        path = safe_join(os.path.abspath(settings.MEDIA_ROOT), name)
+    except ValueError:
+        raise Http404()
+    return serve_file(request, path, max_age=remaining, private=True, immutable=True)
+
+
+def _may_see_picture(person, viewer, public):
+    if viewer is not None and viewer.is_authenticated:
+        return True
+    if public is None:
+        public = picture_is_public(person.player_uuid)
+    return public
+
+
+def profile_picture_url(person, viewer, key='full', public=None):
+    '''
+    Gets the URL `viewer` should load for one derivative of `person`'s profile picture: a signed URL
+    if they may see the picture, or the placeholder otherwise.
+
+    Params:
+      person: The Person whose picture is shown
+      viewer: The user that is viewing the page
+      key: Which derivative to show (see DerivedPictureMixin.picture_sizes)
+      public: Whether the picture may be shown to anonymous visitors, if the caller already knows (skips the lookup)
+    '''
+    name = person.picture_derivative_name(key)
+    if name is None or not _may_see_picture(person, viewer, public):
+        return static(person.picture_placeholder)
+    return signed_media_url(name)
+
+
+def profile_picture_srcset(person, viewer, public=None):
+    '''
+    Gets a srcset attribute value of signed URLs for every ready derivative of `person`'s profile picture,
+    or an empty string if `viewer` may not see it.
+    '''
+    if not person.picture or not _may_see_picture(person, viewer, public):
+        return ''
+    return ', '.join(f"{signed_media_url(name)} {person.picture_sizes[key][0]}w"
+                     for key, name in person.picture_derivatives.items() if key in person.picture_sizes)
@@ -1,14 +1,22 @@
-from django.conf import settings
 from django.contrib.auth.models import AbstractUser, UserManager
 from django.core.validators import RegexValidator
 from django.db import models
 from django.db.models import CharField, Q
 from django.db.models.functions import Concat
 from django.db.models.functions import Upper
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.templatetags.static import static
 
+from .announcements import invalidate_announcements
+from .caching import API_KEY_CACHE_NAMESPACE, CLAN_CACHE_NAMESPACE, bump_cache_version
+from .events import record_event
+from .images import picture_processed, queue_picture_processing
+from .leaderboard import invalidate_leaderboard, record_tag, record_turned
+from .navbar import invalidate_active_game, invalidate_navbar_role
+from .notifications import notify
+from .sprites import queue_badge_sprite_rebuild
+
 alphanumeric = RegexValidator(r'^[0-9a-zA-Z ]*$', 'Only alphanumeric characters are allowed.')
 hex_rgb = RegexValidator(r'^#[0-9a-fA-F]{6}$', 'Only hex color codes e.g. #52fa3d are allowed.')
 
@@ -20,10 +28,6 @@ import random
 import string
 from django.utils import timezone
 from tinymce import models as tinymce_models
-from PIL import Image
-from io import BytesIO
-from django.core.files.uploadedfile import InMemoryUploadedFile
-import sys
 
 
 def generate_id(length=10):
@@ -62,18 +66,75 @@ def get_relative_time(delta):
         return f'{delta.seconds // 60} mins ago'
     return 'just a moment ago!'
 
-def resize_image(photo, width, height, format="JPEG"):
-    im = Image.open(photo)
-    output = BytesIO()
-    im = im.convert('RGB')
-    #Resize/modify the image
-    im.thumbnail( (width,height) , Image.Resampling.LANCZOS )
-    #after modifications, save it to the output
-    im.save(output, format=format, quality=95)
-    output.seek(0)
-    #change the imagefield value to be the newley modifed image value
-    return InMemoryUploadedFile(output,'ImageField', "%s.jpg" % photo.name.split('.')[0], 'image/jpeg', sys.getsizeof(output), None)
+class DerivedPictureMixin:
+    '''
+    Shared behaviour for models whose `picture` is stored as the uploaded original and displayed
+    through resized derivatives that are generated off the request thread (see images.py).
+
+    Models using this define a `picture_derivatives` JSONField, which maps each key of
+    `picture_sizes` to the storage name of its derivative once that derivative is ready.
+    '''
+    # {key: (width, height, format)}. Listings show small thumbnails, so keep a few sizes around for srcset
+    picture_sizes = {
+        'full': (400, 400, 'WEBP'),
+        '192': (192, 192, 'WEBP'),
+        '96': (96, 96, 'WEBP'),
+        '48': (48, 48, 'WEBP'),
+    }
+    picture_placeholder = 'images/noprofile.png'
+
+    def picture_derivative_name(self, key='full'):
+        '''
+        Gets the storage name of one derivative of this picture, or None if there is no picture
+        or its derivatives are still being generated.
+        '''
+        if not self.picture:
+            return None
+        # Pictures processed before a size was added fall back to their full-size derivative
+        return self.picture_derivatives.get(key) or self.picture_derivatives.get('full')
 
+    def picture_derivative_url(self, key='full'):
+        '''
+        Gets the URL of one derivative of this picture, or of the placeholder image if there is no
+        picture or its derivatives are still being generated.
+        '''
+        name = self.picture_derivative_name(key)
+        if name:
+            return self.picture.storage.url(name)
+        return static(self.picture_placeholder)
+
+    @property
+    def picture_url(self):
+        return self.picture_derivative_url('full')
+
+    @property
+    def thumbnail_url(self):
+        return self.picture_derivative_url('96')
+
+    @property
+    def picture_srcset(self):
+        '''
+        Gets a srcset attribute value listing every ready derivative by width, so browsers only
+        download the smallest one that is sharp enough for where the picture is displayed.
+        '''
+        if not self.picture:
+            return ''
+        return ', '.join(f"{self.picture.storage.url(name)} {self.picture_sizes[key][0]}w"
+                         for key, name in self.picture_derivatives.items() if key in self.picture_sizes)
+
+
+def clan_text_color(color):
+    '''
+    Gets the text color that stays readable on a clan's background `color`.
+    '''
+    r = int(color[1:3], 16)
+    g = int(color[3:5], 16)
+    b = int(color[5:7], 16)
+    total_brightness = r+g+b
+    if total_brightness > 200:
+        return "#222222"
+    else:
+        return "#dddddd"
 
 def get_clan_upload_path(instance, filename):
     return os.path.join("clan_pictures",str(instance.name), filename)
@@ -81,10 +142,11 @@ def get_clan_upload_path(instance, filename):
 # Only needed for database migration nonsense, not actually used
 get_team_upload_path = get_clan_upload_path
 
-class Clan(models.Model):
+class Clan(DerivedPictureMixin, models.Model):
     name = models.CharField(max_length=100, verbose_name="Clan Name", unique=True, validators=[alphanumeric])
     clan_uuid = models.UUIDField(primary_key=True, unique=True, default=uuid.uuid4, editable=False)
     picture = models.ImageField(upload_to=get_clan_upload_path, null=True)
+    picture_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     leader = models.ForeignKey('Person', on_delete=models.SET_NULL, null=True, related_name="clan_leader")
     disband_timestamp = models.DateTimeField(null=True, blank=True)
     color = models.CharField(max_length=7, verbose_name="Clan Color", validators=[hex_rgb], default="#222222")
@@ -104,31 +166,21 @@ class Clan(models.Model):
         return self.name
 
     def save(self, *args, **kwargs):
-        if self.picture and (self.picture != self.__original_picture):
-            self.picture = resize_image(self.picture, 400, 400, 'PNG')
+        picture_changed = self.picture and (self.picture != self.__original_picture)
+        if picture_changed:
+            self.picture_derivatives = {}
         super().save()
+        self.__original_picture = self.picture
+        if picture_changed:
+            queue_picture_processing(self)
 
     @property
     def get_text_color(self):
-        r = int(self.color[1:3], 16)
-        g = int(self.color[3:5], 16)
-        b = int(self.color[5:7], 16)
-        total_brightness = r+g+b
-        if total_brightness > 200:
-            return "#222222"
-        else:
-            return "#dddddd"
+        return clan_text_color(self.color)
         
     @property
     def use_dark_text_color(self):
-        r = int(self.color[1:3], 16)
-        g = int(self.color[3:5], 16)
-        b = int(self.color[5:7], 16)
-        total_brightness = r+g+b
-        if total_brightness > 200:
-            return "true"
-        else:
-            return "false"
+        return "true" if clan_text_color(self.color) == "#222222" else "false"
         
     @property
     def get_member_count(self):
@@ -245,10 +297,11 @@ class CaseInsensitiveUserManager(UserManager):
         case_insensitive_username_field = '{}__iexact'.format(self.model.USERNAME_FIELD)
         return self.get(**{case_insensitive_username_field: username})
     
-class Person(AbstractUser):
+class Person(DerivedPictureMixin, AbstractUser):
     player_uuid = models.UUIDField(verbose_name="Player UUID", default=uuid.uuid4, unique=True)
     clan = models.ForeignKey(Clan, on_delete=models.SET_NULL, blank=True, null=True, related_name="clan_members")
     picture = models.ImageField(upload_to=get_person_upload_path, null=True, blank=True)
+    picture_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     objects = CaseInsensitiveUserManager()
     full_name_objects = PersonFullNameManager()
     discord_id = models.CharField(max_length=100, blank=True, null=True)
@@ -259,15 +312,19 @@ class Person(AbstractUser):
         unique=True,
     )
     is_banned = models.BooleanField(verbose_name="Player is banned.", default=False)
+    unread_notifications = models.PositiveIntegerField(verbose_name="Unread notifications", default=0, editable=False)
     ban_timestamp = models.DateTimeField(null=True, blank=True, auto_now_add=False)
     #USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['first_name', 'last_name', 'email']
 
     __original_picture = None
+    __original_clan_id = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.__original_picture = self.picture
+        # Read through __dict__ so loading a Person without its clan column doesn't cost a query
+        self.__original_clan_id = self.__dict__.get('clan_id')
 
     def __str__(self):
         return f"{self.player_uuid}: ({self.first_name} {self.last_name[0]}.)"
@@ -305,13 +362,6 @@ class Person(AbstractUser):
     def mod_this_game(self):
         return self.current_status.is_mod()
 
-    @property
-    def picture_url(self):
-        if self.picture:
-            return self.picture.url
-        else:
-            return static('/images/noprofile.png')
-
     @property
     def is_a_clan_leader(self):
         return Clan.objects.filter(leader=self).count() > 0
@@ -328,9 +378,22 @@ class Person(AbstractUser):
     def save(self, *args, **kwargs):
         self.first_name = html.escape(self.first_name).capitalize()
         self.last_name = html.escape(self.last_name)
-        if self.picture and (self.picture != self.__original_picture):
-            self.picture = resize_image(self.picture, 400, 400, 'PNG')
-        super().save()
+        picture_changed = self.picture and (self.picture != self.__original_picture)
+        if picture_changed:
+            self.picture_derivatives = {}
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None and not self._state.adding:
+            # unread_notifications is only ever changed in the database (see notifications.py), so writing back the copy
+            # loaded with this instance would undo every notification sent since
+            update_fields = [field.name for field in self._meta.concrete_fields
+                             if not field.primary_key and field.attname in self.__dict__ and field.name != 'unread_notifications']
+        super().save(update_fields=update_fields)
+        self.__original_picture = self.picture
+        if picture_changed:
+            queue_picture_processing(self)
+        if 'clan_id' in self.__dict__ and self.clan_id != self.__original_clan_id:
+            self.__original_clan_id = self.clan_id
+            bump_cache_version(CLAN_CACHE_NAMESPACE)
 
 class OZEntry(models.Model):
     player = models.ForeignKey(Person, on_delete=models.CASCADE)
@@ -344,7 +407,8 @@ class PlayerStatus(models.Model):
     tag1_uuid =   models.CharField(verbose_name="Tag #1 ID", editable=True, default=generate_tag_id, max_length=36)
     tag2_uuid =   models.CharField(verbose_name="Tag #2 ID", editable=True, default=generate_tag_id, max_length=36)
     zombie_uuid = models.CharField(verbose_name="Zombie ID", editable=True, default=generate_tag_id, max_length=36)
-    printed = models.BooleanField(verbose_name="Has Player's ID card been printed?", default=False) ## UNUSED
+    printed = models.BooleanField(verbose_name="Has Player's ID card been printed?", default=False)
+    printed_codes = models.CharField(verbose_name="IDs on the printed card", max_length=110, blank=True, default='')
     activation_timestamp = models.DateTimeField(auto_now_add=False, null=True, blank=True)
     game = models.ForeignKey(Game, on_delete=models.CASCADE)
     status = models.CharField(verbose_name="Role", choices=[('h','Human'),('v','Human (used AV)'),('e', 'Human (Extracted)'),('z','Zombie'),('x','Zombie (used AV)'),('m','Mod'),('a','Admin'),("o","Zombie (OZ)"),("n","NonPlayer")], max_length=1, default='n', null=False)
@@ -357,9 +421,29 @@ class PlayerStatus(models.Model):
                            ('zombie_uuid', 'game'),
                            ('player', 'game'))
 
+    __original_status = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__original_status = self.__dict__.get('status')
+
     def __str__(self) -> str:
         return f"Status of {self.player} during game \"{self.game}\" ({self.get_status_display()})"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        invalidate_navbar_role(self.player_id)
+        if 'status' in self.__dict__ and self.status != self.__original_status:
+            # Tags are applied to the cached clan leaderboard as they happen. Anything else rebuilds it
+            if self.__original_status in ['h','v'] and self.status in ['z','x']:
+                record_turned(self)
+            else:
+                invalidate_leaderboard()
+            # Making a player an OZ is what reveals them
+            record_event(self.game_id, 'o' if self.status == 'o' else 's', self.player_id,
+                         data={'from': self.__original_status, 'to': self.status})
+            self.__original_status = self.status
+
     def is_zombie(self):
         return self.status in ['z','o','x']
 
@@ -437,6 +521,19 @@ class AntiVirus(models.Model):
     expiration_time = models.DateTimeField()
     note = models.CharField(verbose_name="Note (optional)", null=True, blank=True, max_length=100)
 
+    __original_used_by_id = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__original_used_by_id = self.__dict__.get('used_by_id')
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if 'used_by_id' in self.__dict__ and self.used_by_id != self.__original_used_by_id:
+            if self.used_by_id is not None:
+                record_event(self.game_id, 'a', self.used_by_id, data={'av_code': self.av_code})
+            self.__original_used_by_id = self.used_by_id
+
     @property
     def get_status(self):
         if self.used_by is not None:
@@ -509,20 +606,32 @@ class FailedAVAttempt(models.Model):
         return f"<span class='avtimestamp'>{self.display_timestamp}:</span> {html.escape(self.code_used)}"
     
 
-class BadgeType(models.Model):
+class BadgeType(DerivedPictureMixin, models.Model):
     badge_name = models.CharField(verbose_name="Badge Name", max_length=30, null=False)
     picture = models.ImageField(upload_to="badge_icons/", null=True)
+    picture_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     badge_type = models.CharField(verbose_name="Badge Type", choices=[('a','Account (persistent)'),('g','Game (resets after each game)')], max_length=1, null=False, default='g')
     badge_description = models.CharField(verbose_name="Badge Description", max_length=256, null=False)
     mod_grantable = models.BooleanField(verbose_name="Can Moderators (not just admins) grant this badge", default=False)
     active = models.BooleanField(verbose_name="Is this badge still able to be earned / granted?", default=True)
+
+    __original_picture = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__original_picture = self.picture
+
     def __str__(self) -> str:
         return f"{self.badge_name}"
 
     def save(self, *args, **kwargs):
-        if self.picture:
-            self.picture = resize_image(self.picture, 400, 400, "PNG")
+        picture_changed = self.picture and (self.picture != self.__original_picture)
+        if picture_changed:
+            self.picture_derivatives = {}
         super().save()
+        self.__original_picture = self.picture
+        if picture_changed:
+            queue_picture_processing(self)
 
     @staticmethod
     def attempt_give_badge(badge_name: str, player: Person, game: Game) -> bool:
@@ -547,25 +656,89 @@ class BadgeInstance(models.Model):
         return f"{self.badge_type.badge_name} earned by {self.player} at {self.timestamp.astimezone(timezone.get_current_timezone()).strftime('%Y-%m-%d %H:%M:%S')}"
 
 
+class BadgeSprite(SingletonModel):
+    '''
+    The sprite sheet of every active badge icon, so a page full of badges loads one image instead of one per badge.
+    Rebuilt by sprites.py whenever a badge type changes; both files are named after their content.
+    '''
+    image = models.CharField(max_length=255, blank=True, default='')
+    stylesheet = models.CharField(max_length=255, blank=True, default='')
+    badge_types = models.JSONField(default=list, blank=True)
+
+
+@receiver(post_save, sender=CurrentGame)
+def active_game_changed(**kwargs):
+    invalidate_active_game()
+
+
+# Revoking, expiring or deleting a key must stop the cached verifications of it at once
+@receiver(post_save, sender='rest_framework_api_key.APIKey')
+@receiver(post_delete, sender='rest_framework_api_key.APIKey')
+def api_key_changed(**kwargs):
+    bump_cache_version(API_KEY_CACHE_NAMESPACE)
+
+
+@receiver(post_delete, sender=PlayerStatus)
+def player_status_deleted(instance, **kwargs):
+    invalidate_navbar_role(instance.player_id)
+
+
+@receiver(post_save, sender=Clan)
+@receiver(post_delete, sender=Clan)
+@receiver(picture_processed, sender=Clan)
+def clan_changed(**kwargs):
+    bump_cache_version(CLAN_CACHE_NAMESPACE)
+
+
+@receiver(post_delete, sender=Person)
+def person_deleted(instance, **kwargs):
+    if instance.__dict__.get('clan_id') is not None:
+        bump_cache_version(CLAN_CACHE_NAMESPACE)
+
+
+@receiver(post_save, sender=BadgeType)
+@receiver(post_delete, sender=BadgeType)
+def badge_type_changed(**kwargs):
+    queue_badge_sprite_rebuild()
+
+
+@receiver(picture_processed, sender=BadgeType)
+def badge_picture_processed(**kwargs):
+    queue_badge_sprite_rebuild()
+
+
 def get_blaster_upload_path(instance, filename):
         return os.path.join("blaster_pictures",str(instance.owner.player_uuid), filename)
 
 
-class Blaster(models.Model):
+class Blaster(DerivedPictureMixin, models.Model):
     name = models.CharField(max_length=100, default="No name given")
     owner = models.ForeignKey(Person, on_delete=models.CASCADE, null=False, related_name="owned_blasters")
     game_approved_in = models.ForeignKey(Game, on_delete=models.SET_NULL, null=True)
     approved_by = models.ManyToManyField(Person, related_name="approved_blasters", limit_choices_to={'is_staff': True})
     picture = models.ImageField(upload_to=get_blaster_upload_path, null=True)
+    picture_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     avg_chrono = models.FloatField(verbose_name="Average Chronograph velocity", default=0)
 
+    picture_sizes = {'full': (400, 400, 'JPEG')}
+
+    __original_picture = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__original_picture = self.picture
+
     def __str__(self) -> str:
         return f"Blaster \"{self.name}\" owned by {self.owner}. Avg. FPS: {self.avg_chrono if self.avg_chrono != 0 else 'N/A'}. Approved by {', '.join([str(p) for p in self.approved_by.all()])}"
 
     def save(self, *args, **kwargs):
-        if self.picture:
-            self.picture = resize_image(self.picture, 400, 400)
+        picture_changed = self.picture and (self.picture != self.__original_picture)
+        if picture_changed:
+            self.picture_derivatives = {}
         super().save()
+        self.__original_picture = self.picture
+        if picture_changed:
+            queue_picture_processing(self)
 
 class PostGameSurvey(models.Model):
     game = models.ForeignKey(Game, on_delete=models.CASCADE)#, default=get_latest_game)
@@ -750,7 +923,23 @@ class Tag(models.Model):
             return
 
 
-class Report(models.Model):
+@receiver(post_save, sender=Tag)
+def tag_saved(instance, created, **kwargs):
+    if created:
+        record_tag(instance)
+        record_event(instance.game_id, 't', instance.tagger_id, instance.taggee_id, {'armor': True} if instance.armor_taggee_id else None)
+
+
+@receiver(post_delete, sender=Tag)
+def tag_deleted(**kwargs):
+    invalidate_leaderboard()
+
+
+def get_report_upload_path(instance, filename):
+    return os.path.join("report_images", instance.report_uuid, filename)
+
+
+class Report(DerivedPictureMixin, models.Model):
     report_text = models.TextField(verbose_name="Report Description")
     reporter_email = models.EmailField(verbose_name="Reporter Email", null=True, blank=True)
     reporter = models.ForeignKey(Person, null=True, blank=True, on_delete=models.SET_NULL, related_name="reporters")
@@ -758,9 +947,21 @@ class Report(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True, editable=True)
     status = models.CharField(max_length=1, null=False, default='n', choices=(('n','New'),('i','Investigating'),('d','Dismissed'),('c','Closed')))
     game = models.ForeignKey(Game, null=False, on_delete=models.CASCADE)
-    picture = models.ImageField(upload_to='report_images/', null=True, blank=True)
+    # When the report or its notes last changed, so bots can poll for what changed since they last looked
+    updated = models.DateTimeField(auto_now=True)
+    # Reports filed before attachments existed carry a single picture here; new reports use ReportAttachment
+    picture = models.ImageField(upload_to=get_report_upload_path, null=True, blank=True)
+    picture_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     report_uuid = models.CharField(max_length=10, unique=True, editable=False, null=False, default=generate_report_id)
 
+    picture_sizes = {'full': (1000, 1000, 'JPEG')}
+
+    class Meta:
+        indexes = [
+            # Serves the reports API, which pages through a game's reports in the order they changed
+            models.Index(fields=['game', 'updated', 'id'], name='report_changes'),
+        ]
+
     __original_picture = None
 
     def __init__(self, *args, **kwargs):
@@ -768,9 +969,13 @@ class Report(models.Model):
         self.__original_picture = self.picture
 
     def save(self, *args, **kwargs):
-        if self.picture and (self.picture != self.__original_picture):
-            self.picture = resize_image(self.picture, 1000, 1000, "JPEG")
+        picture_changed = self.picture and (self.picture != self.__original_picture)
+        if picture_changed:
+            self.picture_derivatives = {}
         super().save()
+        self.__original_picture = self.picture
+        if picture_changed:
+            queue_picture_processing(self)
 
     def __str__(self):
         return f"Report ID {self.report_uuid} filed by {self.get_reporter} at {self.timestamp.astimezone(timezone.get_current_timezone()).strftime('%Y-%m-%d %H:%M')}"
@@ -798,6 +1003,9 @@ class Report(models.Model):
 
     @property
     def last_updated(self):
+        # Lists of reports annotate this instead (see AdminHTMLViews.reports)
+        if 'last_update_timestamp' in self.__dict__:
+            return self.last_update_timestamp
         updates = ReportUpdate.objects.filter(report=self).order_by('-timestamp')
         if len(updates) == 0:
             return None
@@ -811,15 +1019,42 @@ class Report(models.Model):
         return f"Report #{self.id}, made by {self.get_reporter} on {self.timestamp.astimezone(timezone.get_current_timezone()).strftime('%Y-%m-%d %H:%M')}. Status: {self.status_text}"
 
 
-@receiver(post_save, sender=Report)
-def update_file_path(instance, created, **kwargs):
-    if created and instance.picture:
-        initial_path = instance.picture.path
-        new_path = settings.MEDIA_ROOT + f'/report_images/{instance.id}.jpeg'
-        os.makedirs(os.path.dirname(new_path), exist_ok=True)
-        os.rename(initial_path, new_path)
-        instance.picture = new_path
-        instance.save()
+def get_report_attachment_upload_path(instance, filename):
+    return os.path.join("report_images", instance.report.report_uuid, filename)
+
+
+class ReportAttachment(DerivedPictureMixin, models.Model):
+    '''
+    An image attached to a report. The report's id is generated before it is first saved,
+    so attachments are written straight to their final location under the report's directory.
+    '''
+    report = models.ForeignKey(Report, on_delete=models.CASCADE, related_name="attachments")
+    picture = models.ImageField(upload_to=get_report_attachment_upload_path)
+    picture_derivatives = models.JSONField(default=dict, blank=True, editable=False)
+
+    # The report queue lists a thumbnail of every attachment
+    picture_sizes = {'full': (1000, 1000, 'JPEG'), '96': (96, 96, 'JPEG')}
+
+    __original_picture = None
+
+    class Meta:
+        ordering = ['id']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__original_picture = self.picture
+
+    def __str__(self):
+        return f"Attachment to report ID {self.report.report_uuid}"
+
+    def save(self, *args, **kwargs):
+        picture_changed = self.picture and (self.picture != self.__original_picture)
+        if picture_changed:
+            self.picture_derivatives = {}
+        super().save()
+        self.__original_picture = self.picture
+        if picture_changed:
+            queue_picture_processing(self)
 
 
 class ReportUpdate(models.Model):
@@ -884,6 +1119,12 @@ class ClanHistoryItem(models.Model):
         ('e','disbanded_by_system')
     ))
 
+    class Meta:
+        indexes = [
+            # Clan history is listed newest first, a page at a time (see clans.clan_history_page)
+            models.Index(fields=['clan', '-timestamp', '-id'], name='clan_history_timeline'),
+        ]
+
     @property
     def timestamp_display(self):
         return self.timestamp.astimezone(timezone.get_current_timezone()).strftime('%Y-%m-%d %H:%M:%S')
@@ -978,6 +1219,108 @@ class NameChangeRequest(models.Model):
     request_open_timestamp = models.DateTimeField(auto_now_add=True)
     request_close_timestamp = models.DateTimeField(null=True, blank=True)
 
+@receiver(post_save, sender=Announcement)
+@receiver(post_delete, sender=Announcement)
+def announcement_changed(**kwargs):
+    invalidate_announcements()
+
+
+class Notification(models.Model):
+    '''
+    An entry in a player's notification inbox. Entries are written when something happens (see notifications.notify),
+    and Person.unread_notifications counts the unread ones so pages never have to.
+    '''
+    recipient = models.ForeignKey(Person, on_delete=models.CASCADE, related_name="notifications")
+    kind = models.CharField(max_length=1, choices=(
+        ('i','clan_invitation'),
+        ('r','clan_join_request'),
+        ('n','name_change_request'),
+        ('u','report_update'),
+        ('b','badge_award'),
+    ))
+    message = models.CharField(max_length=300)
+    link = models.CharField(max_length=256, blank=True, default='')
+    timestamp = models.DateTimeField(auto_now_add=True)
+    read = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ['-timestamp', '-id']
+        indexes = [
+            models.Index(fields=['recipient', '-timestamp', '-id'], name='notification_inbox'),
+        ]
+
+    def __str__(self) -> str:
+        return f"Notification for {self.recipient}: {self.message}"
+
+    @property
+    def timestamp_display(self):
+        return self.timestamp.astimezone(timezone.get_current_timezone()).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class GameEvent(models.Model):
+    '''
+    An entry in a game's feed of what happened, served by /api/events (see events.py).
+    Events are only ever added, never changed, so their ids are the feed's cursor.
+    '''
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name="events")
+    kind = models.CharField(max_length=1, choices=(
+        ('t','tag'),
+        ('a','av_used'),
+        ('s','status_change'),
+        ('o','oz_revealed'),
+        ('b','badge_granted'),
+    ))
+    player = models.ForeignKey(Person, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    other = models.ForeignKey(Person, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+    data = models.JSONField(default=dict, blank=True)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['game', 'id'], name='game_event_feed'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.get_kind_display()} in game \"{self.game}\" at {self.timestamp}"
+
+
+@receiver(post_save, sender=ClanInvitation)
+def clan_invitation_sent(instance, created, **kwargs):
+    if created:
+        notify([instance.invitee_id], 'i', f"{instance.inviter} has invited you to join clan {instance.clan.name}", "/notifications/")
+
+
+@receiver(post_save, sender=ClanJoinRequest)
+def clan_join_requested(instance, created, **kwargs):
+    if created:
+        notify([instance.clan.leader_id], 'r', f"{instance.requestor} has requested to join clan {instance.clan.name}", "/notifications/")
+
+
+@receiver(post_save, sender=NameChangeRequest)
+def name_change_requested(instance, created, **kwargs):
+    if created:
+        # NOTE: A superuser is ALWAYS considered an admin
+        admins = Person.objects.filter(Q(is_superuser=True) | Q(playerstatus__game=get_active_game(), playerstatus__status='a'))
+        notify(admins.values_list('pk', flat=True).distinct(), 'n',
+               f"{instance.player} has requested a name change", "/admin/name_change_requests/")
+
+
+@receiver(post_save, sender=ReportUpdate)
+def report_updated(instance, created, **kwargs):
+    if created:
+        # A new note is a change to the report, even when the report itself was not saved
+        Report.objects.filter(pk=instance.report_id).update(updated=timezone.now())
+    if created and instance.report.reporter_id != instance.note_creator_id:
+        notify([instance.report.reporter_id], 'u', f"Your report #{instance.report.id} has been updated")
+
+
+@receiver(post_save, sender=BadgeInstance)
+def badge_awarded(instance, created, **kwargs):
+    if created:
+        notify([instance.player_id], 'b', f"You earned the {instance.badge_type.badge_name} badge", f"/player/{instance.player.player_uuid}/")
+        record_event(instance.game_awarded_id, 'b', instance.player_id, data={'badge': instance.badge_type.badge_name})
+
+
 class CustomRedirect(models.Model):
     redirect_name = models.CharField(primary_key=True, unique=True,     verbose_name="Redirect Route Name", max_length=32)
     target = models.CharField(verbose_name="Target Redirect URL", max_length=256)
@@ -0,0 +1,60 @@
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Subquery
+
+from .caching import bump_cache_version, invalidated_cache_seconds, versioned_key
+
+# Bumped whenever the active game changes, which changes everyone's role
+GAME_CACHE_NAMESPACE = 'active_game'
+ROLE_CACHE_SECONDS = invalidated_cache_seconds(24 * 60 * 60)
+# How long the navbar fragment in base.html is cached for
+NAVBAR_CACHE_SECONDS = invalidated_cache_seconds(60 * 60)
+
+
+def role_cache_key(user_id):
+    return versioned_key(GAME_CACHE_NAMESPACE, 'navbar_role', user_id)
+
+
+def navbar_role(user):
+    '''
+    Gets the role that decides which links a user's navbar shows: 'anonymous', 'nonplayer', 'human',
+    'zombie', 'zombie_av' (a zombie who may use an AV), 'mod' or 'admin'. Cached until the user's status changes
+    (or for at most a minute without a shared cache, which other processes' invalidations cannot reach).
+    '''
+    if not user.is_authenticated:
+        return 'anonymous'
+    key = role_cache_key(user.pk)
+    role = cache.get(key)
+    if role is None:
+        PlayerStatus = apps.get_model('hvz', 'PlayerStatus')
+        CurrentGame = apps.get_model('hvz', 'CurrentGame')
+        status = PlayerStatus.objects.filter(player=user, game=Subquery(CurrentGame.objects.filter(pk=1).values('current_game'))) \
+            .values_list('status', 'av_banned').first()
+        status, av_banned = status or ('n', False)
+        if status == 'a':
+            role = 'admin'
+        elif status == 'm':
+            role = 'mod'
+        elif status == 'z' and not av_banned:
+            role = 'zombie_av'
+        elif status in ['z', 'x', 'o']:
+            role = 'zombie'
+        elif status in ['h', 'v', 'e']:
+            role = 'human'
+        else:
+            role = 'nonplayer'
+        cache.set(key, role, ROLE_CACHE_SECONDS)
+    return role
+
+
+def invalidate_navbar_role(user_id):
+    transaction.on_commit(lambda: cache.delete(role_cache_key(user_id)))
+
+
+def invalidate_active_game():
+    bump_cache_version(GAME_CACHE_NAMESPACE)
+
+
+def navbar_cache_version():
+    return versioned_key(GAME_CACHE_NAMESPACE, 'navbar')
@@ -0,0 +1,51 @@
+from django.apps import apps
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+NOTIFICATIONS_PAGE_SIZE = 20
+
+
+def notify(recipient_ids, kind, message, link=''):
+    '''
+    Puts a notification in some users' inboxes and counts it towards their unread notifications,
+    with one insert and one update however many users there are.
+
+    Params:
+      recipient_ids: The ids of the Persons to notify (duplicates and None are ignored)
+      kind: One of Notification's kinds
+      message: The text of the notification
+      link: Where the notification leads, if anywhere
+    '''
+    recipient_ids = {recipient_id for recipient_id in recipient_ids if recipient_id is not None}
+    if not recipient_ids:
+        return
+    Notification = apps.get_model('hvz', 'Notification')
+    Person = apps.get_model('hvz', 'Person')
+    with transaction.atomic():
+        Notification.objects.bulk_create([Notification(recipient_id=recipient_id, kind=kind, message=message, link=link)
+                                          for recipient_id in recipient_ids])
+        Person.objects.filter(pk__in=recipient_ids).update(unread_notifications=F('unread_notifications') + 1)
+
+
+def mark_read(user, ids=None):
+    '''
+    Marks some of a user's notifications as read, and takes them off their unread count.
+
+    Params:
+      user: The Person whose notifications to mark
+      ids: The ids of the notifications to mark, or None for all of them
+
+    Returns:
+      int: The number of notifications that were unread
+    '''
+    Notification = apps.get_model('hvz', 'Notification')
+    Person = apps.get_model('hvz', 'Person')
+    with transaction.atomic():
+        unread = Notification.objects.filter(recipient=user, read=False)
+        if ids is not None:
+            unread = unread.filter(id__in=ids)
+        count = unread.update(read=True)
+        if count:
+            Person.objects.filter(pk=user.pk).update(unread_notifications=Greatest(F('unread_notifications') - count, 0))
+    return count
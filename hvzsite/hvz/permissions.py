@@ -0,0 +1,71 @@
+import hashlib
+import threading
+import time
+from collections import defaultdict
+
+from rest_framework_api_key.permissions import HasAPIKey
+
+from .caching import API_KEY_CACHE_NAMESPACE, get_cache_version
+
+# How long a verified key is trusted before it is checked against the database again.
+# Revoking a key bumps the cache version, so this only bounds how long other workers can miss it with a per-process cache
+API_KEY_CACHE_SECONDS = 60
+
+# Digest of the presented key: (key prefix, cache version, time the entry stops being trusted)
+_verified_keys = {}
+# Key prefix: {'hits', 'misses'}, counted by this process since it started
+_key_stats = defaultdict(lambda: {'hits': 0, 'misses': 0})
+_lock = threading.Lock()
+
+
+def api_key_digest(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def api_key_cache_stats():
+    '''
+    Gets how often each API key was found in this process's cache of verified keys.
+
+    Returns:
+      dict: {key prefix: {'hits', 'misses', 'hit_rate'}}
+    '''
+    with _lock:
+        return {prefix: {**stats, 'hit_rate': stats['hits'] / (stats['hits'] + stats['misses'])}
+                for prefix, stats in _key_stats.items()}
+
+
+class CachedHasAPIKey(HasAPIKey):
+    '''
+    HasAPIKey, except that a key which passed verification is trusted for API_KEY_CACHE_SECONDS
+    (or until it expires, if that is sooner) instead of being hashed again on every request.
+    Only valid keys are cached, so guessing keys costs as much as it always did.
+    '''
+    def has_permission(self, request, view):
+        key = self.get_key(request)
+        if not key:
+            return False
+        digest = api_key_digest(key)
+        version = get_cache_version(API_KEY_CACHE_NAMESPACE)
+        now = time.time()
+        with _lock:
+            entry = _verified_keys.get(digest)
+            if entry is not None and entry[1] == version and entry[2] > now:
+                _key_stats[entry[0]]['hits'] += 1
+                return True
+            _verified_keys.pop(digest, None)
+
+        prefix, _, _ = key.partition('.')
+        try:
+            api_key = self.model.objects.get_usable_keys().get(prefix=prefix)
+        except self.model.DoesNotExist:
+            return False
+        if not api_key.is_valid(key) or api_key.has_expired:
+            return False
+
+        valid_until = now + API_KEY_CACHE_SECONDS
+        if api_key.expiry_date is not None:
+            valid_until = min(valid_until, api_key.expiry_date.timestamp())
+        with _lock:
+            _verified_keys[digest] = (prefix, version, valid_until)
+            _key_stats[prefix]['misses'] += 1
+        return True
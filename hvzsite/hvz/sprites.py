@@ -0,0 +1,151 @@
+import hashlib
+import logging
+import math
+import threading
+from io import BytesIO
+
+from PIL import Image, ImageOps
+from django.apps import apps
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+
+from .caching import invalidated_cache_seconds
+from .images import FORMAT_OPTIONS, get_executor
+
+logger = logging.getLogger(__name__)
+
+# Badges are displayed at 50-70px, so a 96px cell stays sharp on most screens
+SPRITE_CELL_SIZE = 96
+SPRITE_SOURCE_DERIVATIVE = '192'
+SPRITE_DIRECTORY = 'badge_sprites'
+BADGE_SPRITE_CACHE_KEY = 'badge_sprite'
+# A rebuild clears the cache, so this only bounds how long other workers can link the old sheet with a per-process cache
+BADGE_SPRITE_CACHE_SECONDS = invalidated_cache_seconds(24 * 60 * 60)
+
+_rebuild_lock = threading.Lock()
+_rebuild_pending = False
+
+
+def render_badge_sprite(badge_types):
+    '''
+    Renders a sprite sheet of badge icons, along with where each one sits on it.
+
+    Icons are laid out in a square-ish grid, and offsets are given as percentages so a sprite can be shown
+    at any size, as long as the element is square (which `player_badge_img` and `dt_profile` already are).
+
+    Params:
+      badge_types: The BadgeTypes to include. Each must have a ready derivative
+
+    Returns:
+      (bytes, dict): The encoded sheet, and {badge type id: (x%, y%)} background positions
+    '''
+    columns = max(1, math.ceil(math.sqrt(len(badge_types))))
+    rows = max(1, math.ceil(len(badge_types) / columns))
+    sheet = Image.new('RGB', (columns * SPRITE_CELL_SIZE, rows * SPRITE_CELL_SIZE), 'white')
+    positions = {}
+    for index, badge_type in enumerate(badge_types):
+        column, row = index % columns, index // columns
+        with default_storage.open(badge_type.picture_derivative_name(SPRITE_SOURCE_DERIVATIVE), 'rb') as f, Image.open(f) as icon:
+            # Crop to the cell like the `object-fit: cover` used by the <img> version
+            cell = ImageOps.fit(icon.convert('RGB'), (SPRITE_CELL_SIZE, SPRITE_CELL_SIZE), Image.Resampling.LANCZOS)
+        sheet.paste(cell, (column * SPRITE_CELL_SIZE, row * SPRITE_CELL_SIZE))
+        # Percentages are of the sheet's slack, so they must not be rounded to whole numbers or neighbouring cells show through
+        positions[badge_type.id] = (round(column * 100 / max(1, columns - 1), 4), round(row * 100 / max(1, rows - 1), 4))
+    output = BytesIO()
+    sheet.save(output, format='WEBP', **FORMAT_OPTIONS['WEBP'])
+    return output.getvalue(), positions
+
+
+def render_sprite_stylesheet(sheet_url, positions):
+    '''
+    Renders the stylesheet that shows each badge's cell of the sprite sheet at `sheet_url`.
+    '''
+    columns = max(1, math.ceil(math.sqrt(len(positions))))
+    rows = max(1, math.ceil(len(positions) / columns))
+    rules = [f".badge_sprite {{ display: inline-block; background-image: url({sheet_url}); "
+             f"background-size: {columns * 100}% {rows * 100}%; }}"]
+    rules.extend(f".badge_sprite_{badge_type_id} {{ background-position: {x:g}% {y:g}%; }}"
+                 for badge_type_id, (x, y) in positions.items())
+    return '\n'.join(rules) + '\n'
+
+
+def save_hashed(extension, data):
+    '''
+    Stores sprite data under a name derived from its content, so it can be cached forever.
+    '''
+    name = f"{SPRITE_DIRECTORY}/badges.{hashlib.sha256(data).hexdigest()[:12]}.{extension}"
+    if not default_storage.exists(name):
+        name = default_storage.save(name, ContentFile(data))
+    return name
+
+
+def build_badge_sprite():
+    '''
+    Rebuilds the sprite sheet of every active badge type whose icon has been processed, and publishes it on the BadgeSprite.
+    '''
+    BadgeType = apps.get_model('hvz', 'BadgeType')
+    BadgeSprite = apps.get_model('hvz', 'BadgeSprite')
+    badge_types = [badge_type for badge_type in BadgeType.objects.filter(active=True).order_by('id')
+                   if badge_type.picture_derivative_name(SPRITE_SOURCE_DERIVATIVE)]
+    sprite = BadgeSprite.load()
+    old_names = {sprite.image, sprite.stylesheet} - {''}
+    if badge_types:
+        data, positions = render_badge_sprite(badge_types)
+        sprite.image = save_hashed('webp', data)
+        sprite.stylesheet = save_hashed('css', render_sprite_stylesheet(default_storage.url(sprite.image), positions).encode())
+    else:
+        sprite.image = sprite.stylesheet = ''
+    sprite.badge_types = [badge_type.id for badge_type in badge_types]
+    sprite.save()
+    cache.delete(BADGE_SPRITE_CACHE_KEY)
+    for name in old_names - {sprite.image, sprite.stylesheet}:
+        default_storage.delete(name)
+
+
+def rebuild_badge_sprite():
+    global _rebuild_pending
+    try:
+        with _rebuild_lock:
+            _rebuild_pending = False
+        build_badge_sprite()
+    except Exception:
+        logger.exception("Failed to rebuild the badge sprite sheet")
+    finally:
+        close_old_connections()
+
+
+def queue_badge_sprite_rebuild():
+    '''
+    Queues a rebuild of the badge sprite sheet once the surrounding transaction commits.
+    Changes made while a rebuild is already queued are picked up by that rebuild.
+    '''
+    def submit():
+        global _rebuild_pending
+        with _rebuild_lock:
+            if _rebuild_pending:
+                return
+            _rebuild_pending = True
+        get_executor().submit(rebuild_badge_sprite)
+
+    transaction.on_commit(submit)
+
+
+def get_badge_sprite():
+    '''
+    Gets the current sprite sheet (cached until it is rebuilt, or for BADGE_SPRITE_CACHE_SECONDS).
+
+    Returns:
+      dict: {'stylesheet': URL of the stylesheet, or None if there is no sheet, 'badge_types': set of the ids of the included badge types}
+    '''
+    sprite = cache.get(BADGE_SPRITE_CACHE_KEY)
+    if sprite is None:
+        BadgeSprite = apps.get_model('hvz', 'BadgeSprite')
+        model = BadgeSprite.load()
+        sprite = {
+            'stylesheet': default_storage.url(model.stylesheet) if model.stylesheet else None,
+            'badge_types': set(model.badge_types),
+        }
+        cache.set(BADGE_SPRITE_CACHE_KEY, sprite, BADGE_SPRITE_CACHE_SECONDS)
+    return sprite
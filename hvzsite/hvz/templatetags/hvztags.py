@@ -1,5 +1,8 @@
 from django import template
+from django.utils.html import format_html
 from hvz.models import PostGameSurveyResponse, PostGameSurvey, Person, PlayerStatus
+from hvz import codes, media
+from hvz.sprites import get_badge_sprite
 
 register = template.Library()
 
@@ -43,9 +46,78 @@ def get_player_name(player, requesting_user):
     if isinstance(player, PlayerStatus):
         player = player.player
 
-    return player.readable_name(authed = requesting_user is not None and \
-                                requesting_user.is_authenticated and \
-                                requesting_user.active_this_game)
+    if requesting_user is None or not requesting_user.is_authenticated:
+        return player.readable_name(authed = False)
+    # Pages list many names, so look up whether the requesting user plays this game once per request rather than once per name
+    if not hasattr(requesting_user, '_active_this_game'):
+        requesting_user._active_this_game = requesting_user.active_this_game
+    return player.readable_name(authed = requesting_user._active_this_game)
+
+@register.simple_tag
+def profile_picture_url(player, requesting_user, size='full'):
+    '''
+    Get the URL of a player's profile picture as `requesting_user` may see it.
+    Pictures they may see are linked through a signed URL that browsers can cache; the rest show the placeholder.
+
+    Params:
+      player: The Person or PlayerStatus whose picture is shown
+      requesting_user: The user that is requesting this picture
+      size: Which derivative to show (see DerivedPictureMixin.picture_sizes)
+    '''
+    if isinstance(player, PlayerStatus):
+        player = player.player
+    return media.profile_picture_url(player, requesting_user, size)
+
+@register.simple_tag
+def profile_picture_srcset(player, requesting_user):
+    if isinstance(player, PlayerStatus):
+        player = player.player
+    return media.profile_picture_srcset(player, requesting_user)
+
+@register.simple_tag
+def code_data_uri(kind, value, format, theme='light', level='l'):
+    '''
+    Get a server-rendered QR or DataMatrix code as a data: URI, so the value it encodes never appears in a request URL.
+
+    Params:
+      kind: 'qr' or 'datamatrix'
+      value: The text to encode
+      format: 'svg' or 'png'
+      theme: 'light' for dark modules on white, or 'dark' for light modules on a transparent background
+      level: The QR error correction level ('l', 'm', 'q' or 'h')
+    '''
+    return codes.code_data_uri(kind, str(value), format, theme, level)
+
+def _badge_sprite(context):
+    # Look the sprite sheet up once per render instead of once per badge
+    if 'badge_sprite' not in context.render_context:
+        context.render_context['badge_sprite'] = get_badge_sprite()
+    return context.render_context['badge_sprite']
+
+@register.simple_tag(takes_context=True)
+def badge_sprite_stylesheet(context):
+    stylesheet = _badge_sprite(context)['stylesheet']
+    if stylesheet is None:
+        return ''
+    return format_html('<link rel="stylesheet" href="{}" />', stylesheet)
+
+@register.simple_tag(takes_context=True)
+def badge_icon(context, badge_type, css_class, sizes):
+    '''
+    Show a badge type's icon from the badge sprite sheet, falling back to its own image
+    if it is not on the sheet (inactive badges, or icons that are still being processed).
+    Pages using this must include {% badge_sprite_stylesheet %}.
+
+    Params:
+      badge_type: The BadgeType to show
+      css_class: The class that sizes the icon. It must give the icon a square size
+      sizes: The `sizes` attribute for the fallback image
+    '''
+    if badge_type.id in _badge_sprite(context)['badge_types']:
+        return format_html('<span role="img" aria-label="{}" title="{}" class="badge_sprite badge_sprite_{} {}"></span>',
+                           badge_type.badge_name, badge_type.badge_description, badge_type.id, css_class)
+    return format_html('<img src="{}" srcset="{}" sizes="{}" title="{}" class="{}" />',
+                       badge_type.thumbnail_url, badge_type.picture_srcset, sizes, badge_type.badge_description, css_class)
 
 @register.simple_tag
 def scoreboard_visible(scoreboard, requesting_user):
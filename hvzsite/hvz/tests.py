@@ -1 +1,24 @@
-# Create your tests here.
+from django.test import TestCase
+
+from .models import Clan, Person
+
+
+class ClanHistoryApiTests(TestCase):
+    def setUp(self):
+        self.admin = Person.objects.create_superuser(username="admin@rit.edu", email="admin@rit.edu", password="password",
+                                                     first_name="Admin", last_name="User")
+        Clan.objects.create(name="Clan1", leader=self.admin)
+        self.client.force_login(self.admin)
+
+    def test_first_page(self):
+        response = self.client.get("/api/clan/Clan1/history/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["next"], None)
+
+    def test_malformed_cursor(self):
+        response = self.client.get("/api/clan/Clan1/history/?before=garbage_1")
+        self.assertEqual(response.status_code, 400)
+
+    def test_impossible_date_in_cursor(self):
+        response = self.client.get("/api/clan/Clan1/history/?before=2024-13-45T00:00:00_1")
+        self.assertEqual(response.status_code, 400)
@@ -27,6 +27,7 @@ urlpatterns = [
     re_path(r'^players/?$', views.players),
     re_path(r'^report/?$', views.create_report),
     re_path(r'^clans/?$', views.clans),
+    re_path(r'^clans/leaderboard/?$', views.clan_leaderboard),
     re_path(r'^tag/?$', ActivePlayerHTMLViews.tag),
     re_path(r'^av/?$', ActivePlayerHTMLViews.av),
     re_path(r'^blasterapproval/?$', AdminHTMLViews.blasterapproval),
@@ -42,6 +43,9 @@ urlpatterns = [
     re_path(r'^clan/clan_management/(?P<clan_name>[^/]+)/(?P<command>[^/]+)/(?P<person_id>[^/]+)/?$', UserAPIViews.clan_api),
     re_path(r'^clan/invitation_response/(?P<invite_id>[^/]+)/(?P<command>[^/]+)?$', UserAPIViews.clan_api_userresponse),
     re_path(r'^clan/request_response/(?P<request_id>[^/]+)/(?P<command>[^/]+)?$', UserAPIViews.clan_api_leaderresponse),
+    re_path(r'^notifications/?$', UserHTMLViews.notifications),
+    re_path(r'^api/notifications/?$', UserAPIViews.notifications_api),
+    re_path(r'^api/notifications/read/?$', UserAPIViews.notifications_mark_read),
     re_path(r'^modify_clan/(?P<clan_name>[^/]+)/', UserHTMLViews.modify_clan_view),
     re_path(r'^announcement/(?P<announcement_id>[^/]+)/?$', views.view_announcement),
     re_path(r'^tags/?$', views.view_tags),
@@ -63,6 +67,7 @@ urlpatterns = [
     re_path(r'^admin/cullaccounts/?$', AdminHTMLViews.cull_accounts),
     re_path(r'^api/account_culling_api/?$', AdminAPIViews.get_cullable_accounts),
     re_path(r'^api/account_culling_rest/?$', AdminAPIViews.account_culling_rest),
+    re_path(r'^api/api_key_stats/?$', AdminAPIViews.api_key_stats),
     
     re_path(r'^admin/create-av/?$', AdminHTMLViews.admin_create_av),
     re_path(r'^admin/view-avs/?$', AdminHTMLViews.admin_view_avs),
@@ -86,7 +91,8 @@ urlpatterns = [
     re_path(r'^admin/print/?$', AdminHTMLViews.print_choice),
     re_path(r'^admin/view_print/?$', AdminHTMLViews.print_ids),
     re_path(r'^admin/print_one/(?P<player_uuid>[^/]+)/?$', AdminHTMLViews.print_one),
-    # re_path(r'^admin/mark_printed/?$', AdminHTMLViews.mark_printed),
+    re_path(r'^admin/print_queue/?$', AdminHTMLViews.print_queue),
+    re_path(r'^admin/mark_printed/?$', AdminHTMLViews.mark_printed),
     re_path(r'^admin/manage_announcements/?$', AdminHTMLViews.manage_announcements),
     re_path(r'^admin/announcement/(?P<announcement_id>[^/]+)/?$', AdminHTMLViews.edit_announcement),
     re_path(r'^admin/manage_scoreboards/?$', AdminHTMLViews.manage_scoreboards),
@@ -104,17 +110,22 @@ urlpatterns = [
 
     # PII Media
     re_path(r'^media/profile_pictures/(?P<player_uuid>[^/]+)/(?P<fname>[^/]+)/?$', views.profile_picture_view),
+    re_path(r'^media/signed/(?P<expires>[0-9]+)/(?P<signature>[A-Za-z0-9_-]+)/(?P<name>.+)$', views.signed_media_view),
 
     # API Routes
     # re_path(r'^api/?', include(router.urls)),
     re_path(r'^api/discord-id/?$', views.ApiDiscordId.as_view()),
     re_path(r'^api/link-discord-id/?$', views.ApiLinkDiscordId.as_view()),
     re_path(r'^api/player/?$', views.ApiPlayerId.as_view()),
+    re_path(r'^api/players/lookup/?$', views.ApiPlayerLookup.as_view()),
     re_path(r'^api/clans/?$', views.ApiClans.as_view()),
+    re_path(r'^api/clans/leaderboard/?$', views.ApiClanLeaderboard.as_view()),
+    re_path(r'^api/clan/(?P<clan_name>[^/]+)/history/?$', views.clan_history_api),
     re_path(r'^api/players/?$', views.ApiPlayers.as_view()),
     re_path(r'^api/tag/?$', views.ApiTag.as_view()),
     re_path(r'^api/missions/?$', views.ApiMissions.as_view()),
     re_path(r'^api/reports/?$', views.ApiReports.as_view()),
+    re_path(r'^api/events/?$', views.ApiEvents.as_view()),
     re_path(r'^api/create-av/?$', views.ApiCreateAv.as_view()),
     re_path(r'^api/create-armor/?$', views.ApiCreateBodyArmor.as_view()),
 
@@ -1,29 +1,39 @@
 from itertools import chain
+import datetime
 import json
-import os
 from functools import lru_cache
 from itertools import chain
+import uuid
 
 import discord
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import Group
 from django.core import exceptions
-from django.db.models import Q, Count
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Q, Count, OuterRef
 from django.db.models.functions import Lower
 from django.db.utils import IntegrityError
 from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
 from django.shortcuts import render, redirect
-from hvzsite.settings import MEDIA_ROOT, STATIC_ROOT
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import permissions, viewsets
 from rest_framework.decorators import api_view
 from rest_framework.views import APIView
-from rest_framework_api_key.permissions import HasAPIKey
 
+from .api_helpers import count_subquery, decode_cursor, encode_cursor, streaming_json_response
+from .clans import CLAN_DIRECTORY_PAGE_SIZE, clan_directory, clan_history_page
+from .events import EVENTS_MAX_WAIT_SECONDS, wait_for_events
 from .forms import ReportForm
-from .models import About, Announcement, AntiVirus, BadgeInstance, Blaster, BodyArmor, Clan, ClanHistoryItem, \
-    CustomRedirect, DiscordLinkCode, FailedAVAttempt, Mission, PlayerStatus, Person, Report, Rules, Scoreboard, Tag
+from .leaderboard import get_leaderboard
+from .media import profile_picture_srcset, profile_picture_url, serve_profile_picture, serve_signed_media
+from .models import About, Announcement, AntiVirus, BadgeInstance, Blaster, BodyArmor, Clan, \
+    CustomRedirect, DiscordLinkCode, FailedAVAttempt, Game, Mission, PlayerStatus, Person, Report, ReportAttachment, \
+    Rules, Scoreboard, Tag
 from .models import get_active_game
+from .permissions import CachedHasAPIKey
 from .serializers import GroupSerializer, UserSerializer
 
 if settings.DISCORD_REPORT_WEBHOOK_URL:
@@ -164,23 +174,48 @@ def redirect_view(request, redir_name):
 def clan_view(request, clan_name):
     clan = Clan.objects.get(name=clan_name)
     is_leader = (request.user.is_authenticated and clan.leader == request.user)
-    if is_leader or (request.user.is_authenticated and request.user.admin_this_game):
-        history = ClanHistoryItem.objects.filter(clan=clan).order_by('-timestamp')
-    else:
-        history = []
     can_join = request.user.is_authenticated and Clan.objects.filter(leader=request.user).count() == 0 and request.user.has_ever_played and clan.leader is not None
     context = {
         'clan': clan,
         'roster': Person.objects.filter(clan=clan),
         'is_leader': is_leader,
         'user': request.user,
-        'history': history,
         'can_join': can_join,
         'show_history': is_leader or (request.user.is_authenticated and request.user.admin_this_game)
     }
     return render(request, "clan.html", context)
 
 
+@api_view(["GET"])
+def clan_history_api(request, clan_name):
+    '''
+    Returns one page of a clan's history, newest first, for its leader and admins.
+    Pass the `next` value of a page as the `before` parameter to get the page after it.
+    '''
+    try:
+        clan = Clan.objects.get(name=clan_name)
+    except Clan.DoesNotExist:
+        return HttpResponse(status=404, content='No clan with the given name')
+    if not request.user.is_authenticated or (clan.leader_id != request.user.id and not request.user.admin_this_game):
+        return HttpResponse(status=403, content='Only the clan leader and admins can see clan history')
+    before = before_id = None
+    if 'before' in request.query_params:
+        before, _, before_id = request.query_params['before'].rpartition('_')
+        try:
+            before = parse_datetime(before)
+        except ValueError:
+            # Well formed, but not a real date (e.g. month 13)
+            before = None
+        if before is None or not before_id.isdigit():
+            return HttpResponse(status=400, content='Invalid field: "before"')
+    items, last = clan_history_page(clan, before, before_id)
+    data = {
+        'history': [{'html': item.web_str, 'timestamp': item.timestamp} for item in items],
+        'next': f"{last.timestamp.isoformat()}_{last.id}" if last else None,
+    }
+    return JsonResponse(data)
+
+
 def players(request):
     context = {}
     return render(request, "players.html", context)
@@ -226,12 +261,13 @@ def players_api(request, game=None):
                 person_status = PlayerStatus.objects.get(player=person, game=game)
             except:
                 continue
+            public = person.is_superuser or person_status.status == 'a'
             result.append({
                 "name": f"""<a class="dt_name_link" href="/player/{person.player_uuid}/">{person.readable_name(request.user.is_authenticated and request.user.active_this_game)}</a>""",
-                "pic": f"""<a class="dt_profile_link" href="/player/{person.player_uuid}/"><img src='{person.picture_url}' class='dt_profile' /></a>""",
+                "pic": f"""<a class="dt_profile_link" href="/player/{person.player_uuid}/"><img src='{profile_picture_url(person, request.user, '96', public)}' srcset='{profile_picture_srcset(person, request.user, public)}' sizes='70px' class='dt_profile' /></a>""",
                 "status": {"h": "Human", "a": "Admin", "z": "Zombie", "m": "Mod", "v": "Human", "o": "Zombie", "n": "NonPlayer", "x": "Zombie", "e": "Human (Extracted)"}[person_status.status],
-                "clan": None if person.clan is None else (f"""<a href="/clan/{person.clan.name}/" class="dt_clan_link">person.clan.name</a>""" if (person.clan is None or person.clan.picture is None) else f"""<a href="/clan/{person.clan.name}/" class="dt_clan_link"><img src='{person.clan.picture.url}' class='dt_clanpic' alt='{person.clan}' /><span class="dt_clanname">{person.clan}</span></a>"""),
-                "clan_pic": None if (person.clan is None or person.clan.picture is None) else person.clan.picture.url,
+                "clan": None if person.clan is None else (f"""<a href="/clan/{person.clan.name}/" class="dt_clan_link">person.clan.name</a>""" if (person.clan is None or person.clan.picture is None) else f"""<a href="/clan/{person.clan.name}/" class="dt_clan_link"><img src='{person.clan.thumbnail_url}' srcset='{person.clan.picture_srcset}' sizes='60px' class='dt_clanpic' alt='{person.clan}' /><span class="dt_clanname">{person.clan}</span></a>"""),
+                "clan_pic": None if (person.clan is None or person.clan.picture is None) else person.clan.thumbnail_url,
                 "tags": Tag.objects.filter(tagger=person,game=game).count(),
                 "DT_RowClass": {"h": "dt_human", "v": "dt_human", "e": "dt_human", "a": "dt_admin", "z": "dt_zombie", "o": "dt_zombie", "n": "dt_nonplayer", "x": "dt_zombie", "m": "dt_mod"}[person_status.status],
                 "DT_RowData": {"person_url": f"/player/{person.player_uuid}/", "clan_url": f"/clan/{person.clan.name}/" if person.clan is not None else ""}
@@ -247,10 +283,18 @@ def players_api(request, game=None):
 
 
 def clans(request):
-    context = {"clans" : Clan.objects.all()}
+    show_disbanded = 'disbanded' in request.GET
+    rows = [row for row in clan_directory() if show_disbanded or not row['disbanded']]
+    page = Paginator(rows, CLAN_DIRECTORY_PAGE_SIZE).get_page(request.GET.get('page'))
+    context = {"clans": page, "show_disbanded": show_disbanded}
     return render(request, "clans.html", context)
 
 
+def clan_leaderboard(request):
+    context = {"leaderboard": get_leaderboard(get_active_game())}
+    return render(request, "clan_leaderboard.html", context)
+
+
 def rules(request):
     return render(request, "rules.html", {'rules': Rules.load()})
 
@@ -270,7 +314,11 @@ def create_report(request):
             if request.user.is_authenticated:
                 report.reporter = request.user
             report.status = "n"
-            report.save()
+            # Attachments are written once, straight to the report's directory, and are committed along with the report
+            with transaction.atomic():
+                report.save()
+                attachments = [ReportAttachment.objects.create(report=report, picture=picture)
+                               for picture in form.cleaned_data['attachments']]
             report_complete = True
             report_id = report.report_uuid
             form = ReportForm(authenticated=request.user.is_authenticated)
@@ -281,7 +329,7 @@ def create_report(request):
                                         'reporter_email': report.reporter_email,
                                         'reporter': str(report.reporter),
                                         'timestamp': str(report.timestamp),
-                                        # 'picture' = models.ImageField(upload_to='report_images/', null=True, blank=True)
+                                        'attachments': len(attachments),
                                     }, indent=2))
         else:
             messages.error(request, "Unsuccessful report. Invalid information.")
@@ -303,7 +351,7 @@ class ApiDiscordId(APIView):
       player-name: The full name of the player
     }
     """
-    permission_classes = [HasAPIKey]
+    permission_classes = [CachedHasAPIKey]
 
     def get(self, request):
         r = request.query_params
@@ -326,7 +374,7 @@ class ApiDiscordId(APIView):
 
 
 class ApiLinkDiscordId(APIView):
-    permission_classes = [HasAPIKey]
+    permission_classes = [CachedHasAPIKey]
 
     def get(self, request):
         r = request.query_params
@@ -351,7 +399,7 @@ class ApiLinkDiscordId(APIView):
 
     
 class ApiMissions(APIView):
-    permission_classes = [HasAPIKey]
+    permission_classes = [CachedHasAPIKey]
 
     def get(self, request):
         r = request.query_params
@@ -379,7 +427,7 @@ class ApiMissions(APIView):
         return JsonResponse(data)
 
 class ApiPlayerId(APIView):
-    permission_classes = [HasAPIKey]
+    permission_classes = [CachedHasAPIKey]
 
     def get(self, request):
         r = request.query_params
@@ -410,6 +458,87 @@ class ApiPlayerId(APIView):
         }
         return JsonResponse(data)
 
+
+class ApiPlayerLookup(APIView):
+    """
+    Looks up many players at once by any mix of discord IDs, player UUIDs and zombie IDs,
+    with the same three queries however many are asked for.
+
+    @body {
+      discord-ids: [discord ids]
+      uuids: [player UUIDs]
+      zids: [zombie ids in the active game]
+    } (every list is optional)
+    @return {
+      discord-ids, uuids, zids: {input: player, or {error: why it was not found}}
+    } where a player is {uuid, discord-id, clan, email, name, status, tags}
+    """
+    permission_classes = [CachedHasAPIKey]
+    MAX_LOOKUPS = 1000
+    FIELDS = ['discord-ids', 'uuids', 'zids']
+
+    def post(self, request):
+        r = request.data
+        if not isinstance(r, dict):
+            return HttpResponse(status=400, content='The body must be a JSON object')
+        lookups = {}
+        for field in self.FIELDS:
+            values = r.get(field, [])
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                return HttpResponse(status=400, content=f'Invalid field: "{field}" must be a list of strings')
+            lookups[field] = list(dict.fromkeys(values))
+        if sum(len(values) for values in lookups.values()) > self.MAX_LOOKUPS:
+            return HttpResponse(status=400, content=f'Too many lookups, at most {self.MAX_LOOKUPS} per request')
+
+        valid_uuids = {}
+        for value in lookups['uuids']:
+            try:
+                valid_uuids[value] = uuid.UUID(value)
+            except ValueError:
+                pass
+
+        game = get_active_game()
+        people = Person.objects.filter(Q(discord_id__in=lookups['discord-ids']) | Q(player_uuid__in=valid_uuids.values())).select_related('clan') \
+            if lookups['discord-ids'] or valid_uuids else Person.objects.none()
+        by_discord_id = {}
+        by_uuid = {}
+        for person in people:
+            by_discord_id.setdefault(person.discord_id, person)
+            by_uuid[person.player_uuid] = person
+        zombies = {status.zombie_uuid: status.player for status in PlayerStatus.objects.filter(
+            zombie_uuid__in=lookups['zids'], game=game).select_related('player__clan')} if lookups['zids'] else {}
+
+        # Everyone found, with their status and tags in the active game. Players who have not joined it count as 'n'
+        found = {person.pk: person for person in chain(by_discord_id.values(), by_uuid.values(), zombies.values())}
+        statuses = {row['player']: row for row in PlayerStatus.objects.filter(player__in=found.keys(), game=game)
+                    .annotate(tags=count_subquery(Tag.objects.filter(game=game, tagger=OuterRef('player'))))
+                    .values('player', 'status', 'tags')} if found else {}
+
+        def describe(person, error):
+            if person is None:
+                return {'error': error}
+            status = statuses.get(person.pk, {'status': 'n', 'tags': 0})
+            return {
+                'uuid': person.player_uuid,
+                'discord-id': person.discord_id,
+                'clan': person.clan.clan_uuid if person.clan else None,
+                'email': person.email,
+                'name': person.readable_name(True),
+                'status': status['status'],
+                'tags': status['tags'],
+            }
+
+        data = {
+            'discord-ids': {value: describe(by_discord_id.get(value), 'No player with the given discord id')
+                            for value in lookups['discord-ids']},
+            'uuids': {value: describe(by_uuid.get(valid_uuids.get(value)), 'No player with the given user id')
+                      for value in lookups['uuids']},
+            'zids': {value: describe(zombies.get(value), 'No player with the given zombie id')
+                     for value in lookups['zids']},
+        }
+        return JsonResponse(data)
+
+
 class ApiClans(APIView):
     def get(self, request):
         t = list(Clan.objects.values_list('name', flat=True))
@@ -420,29 +549,52 @@ class ApiClans(APIView):
         return JsonResponse(data)
 
 
-class ApiPlayers(APIView):
+class ApiClanLeaderboard(APIView):
     '''
-    Returns all player information
+    Returns how each clan is doing in the current game
     '''
     def get(self, request):
-        game = get_active_game()
-        players = [
-            {
-                'name': p.readable_name(request.user.is_authenticated and request.user.active_this_game),
-                'id': p.player_uuid,
-                'status': p.current_status.get_status_display(),
-                'tags': p.current_status.num_tags,
-            } for p in Person.full_name_objects.filter(playerstatus__game=game, playerstatus__status__in=['h','v','e','z','o','x','a','m'])
-        ]
-
         data = {
-            'players': players
+            'clans': get_leaderboard(get_active_game())
         }
         return JsonResponse(data)
 
 
+class ApiPlayers(APIView):
+    '''
+    Returns all player information, streamed as it is read from a single query.
+    Optionally filtered by `status` (comma-separated status codes, e.g. "h,v,e") and `clan` (a clan name)
+    '''
+    PLAYING_STATUSES = ['h','v','e','z','o','x','a','m']
+
+    def get(self, request):
+        r = request.query_params
+        game = get_active_game()
+        statuses = self.PLAYING_STATUSES
+        if 'status' in r:
+            statuses = r['status'].split(',')
+            if not set(statuses) <= set(self.PLAYING_STATUSES):
+                return HttpResponse(status=400, content='Invalid status, must be a comma-separated list of: '+str(self.PLAYING_STATUSES))
+        rows = PlayerStatus.objects.filter(game=game, status__in=statuses)
+        if 'clan' in r:
+            rows = rows.filter(player__clan__name__iexact=r['clan'])
+        rows = rows.annotate(tags=count_subquery(Tag.objects.filter(game=game, tagger=OuterRef('player')))) \
+            .values_list('player__first_name', 'player__last_name', 'player__is_superuser', 'player__player_uuid', 'status', 'tags')
+
+        # Same rules as Person.readable_name, without loading each player
+        authed = request.user.is_authenticated and request.user.active_this_game
+        status_names = dict(PlayerStatus._meta.get_field('status').choices)
+        players = ({
+            'name': f"{first_name} {last_name}" if authed or is_superuser or status == 'a' else f"{first_name} {last_name[0]}.",
+            'id': player_uuid,
+            'status': status_names[status],
+            'tags': tags,
+        } for first_name, last_name, is_superuser, player_uuid, status, tags in rows.iterator(chunk_size=1000))
+        return streaming_json_response('players', players)
+
+
 class ApiTag(APIView):
-    permission_classes = [HasAPIKey]
+    permission_classes = [CachedHasAPIKey]
 
     def post(self, request):
         r = request.query_params
@@ -482,25 +634,135 @@ class ApiTag(APIView):
 
 
 class ApiReports(APIView):
-    permission_classes = [HasAPIKey]
+    '''
+    Returns a page of a game's reports in the order they were last changed, oldest change first.
+
+    Params (all optional):
+      game: The id of the game, defaulting to the active game
+      status: A comma-separated list of report statuses, e.g. "n,i"
+      since: Only reports changed after this time (YYYY-MM-DD HH:MM[:ss[.uuuuuu]][TZ])
+      after: The "next" cursor of a previous response, to continue from where it left off
+
+    The response's "next" cursor points after its last report, and "more" says whether another page is ready.
+    Polling with the last "next" cursor returns only the reports filed or changed since.
+
+    A report's `updated` time is set before its transaction commits, so a report that takes a while to commit could
+    appear behind a cursor a client already holds. Reports are only listed once they are
+    settings.FEED_SETTLE_SECONDS old to avoid that.
+    '''
+    permission_classes = [CachedHasAPIKey]
+    PAGE_SIZE = 100
+    STATUSES = ['n','i','d','c']
 
     def get(self, request):
-        data = {
-            'reports': [
-                {
+        r = request.query_params
+        reports = Report.objects.select_related('reporter').order_by('updated', 'id') \
+            .filter(updated__lt=timezone.now() - datetime.timedelta(seconds=settings.FEED_SETTLE_SECONDS))
+        if 'game' in r:
+            if not r['game'].isdigit():
+                return HttpResponse(status=400, content='Invalid game, must be a game id.')
+            reports = reports.filter(game_id=r['game'])
+        else:
+            reports = reports.filter(game=get_active_game())
+        if 'status' in r:
+            statuses = r['status'].split(',')
+            if not set(statuses) <= set(self.STATUSES):
+                return HttpResponse(status=400, content='Invalid status, must be a comma-separated list of: '+str(self.STATUSES))
+            reports = reports.filter(status__in=statuses)
+        if 'since' in r:
+            try:
+                since = parse_datetime(r['since'])
+            except ValueError:
+                since = None
+            if since is None:
+                return HttpResponse(status=400, content='Invalid time format. It must be in YYYY-MM-DD HH:MM[:ss[.uuuuuu]][TZ] format.')
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            reports = reports.filter(updated__gt=since)
+        after = None
+        if 'after' in r:
+            try:
+                after = decode_cursor(r['after'])
+            except ValueError:
+                return HttpResponse(status=400, content='Invalid cursor.')
+            reports = reports.filter(Q(updated__gt=after[0]) | Q(updated=after[0], id__gt=after[1]))
+
+        # One extra report says whether there is another page, without counting
+        page = {'count': 0, 'last': after}
+
+        def rows():
+            for report in reports[:self.PAGE_SIZE + 1].iterator():
+                if page['count'] == self.PAGE_SIZE:
+                    page['more'] = True
+                    return
+                page['count'] += 1
+                page['last'] = (report.updated, report.id)
+                yield {
+                    "id": report.report_uuid,
                     "report-text": report.report_text,
                     "reporter-email": report.reporter_email,
                     "reporter": report.reporter.readable_name(True) if report.reporter else None,
                     "timestamp": report.timestamp,
+                    "updated": report.updated,
                     "status": report.status,
                 }
-                for report in Report.objects.all()],
+
+        return streaming_json_response('reports', rows(), lambda: {
+            'next': encode_cursor(*page['last']) if page['last'] else None,
+            'more': page.get('more', False),
+        })
+
+
+class ApiEvents(APIView):
+    '''
+    Returns what happened in a game (tags, AV uses, status changes, OZ reveals and badge grants), oldest first.
+
+    Params (all optional):
+      since: The "next" cursor of a previous response, to get only what happened since. Defaults to the start of the game
+      wait: Seconds to wait for something to happen if nothing has yet (at most EVENTS_MAX_WAIT_SECONDS)
+      game: The id of the game, defaulting to the active game
+
+    Events are listed once they are settings.FEED_SETTLE_SECONDS old (see events.py), so the cursor never skips one.
+    Waiting is limited to settings.EVENTS_MAX_WAITING requests per process; others return without waiting.
+    '''
+    permission_classes = [CachedHasAPIKey]
+
+    def get(self, request):
+        r = request.query_params
+        since = r.get('since', '0')
+        if not since.isdigit():
+            return HttpResponse(status=400, content='Invalid field: "since" must be a cursor from a previous response')
+        wait = r.get('wait', '0')
+        if not wait.isdigit():
+            return HttpResponse(status=400, content='Invalid field: "wait" must be a whole number of seconds')
+        if 'game' in r:
+            if not r['game'].isdigit():
+                return HttpResponse(status=400, content='Invalid game, must be a game id.')
+            game = Game.objects.filter(id=r['game']).first()
+        else:
+            game = get_active_game()
+        if game is None:
+            return HttpResponse(status=404, content='No such game')
+
+        events = wait_for_events(game, int(since), min(int(wait), EVENTS_MAX_WAIT_SECONDS))
+        data = {
+            'events': [
+                {
+                    'id': event.id,
+                    'kind': event.get_kind_display(),
+                    'timestamp': event.timestamp,
+                    'player': {'uuid': event.player.player_uuid, 'name': event.player.readable_name(True)} if event.player else None,
+                    'other': {'uuid': event.other.player_uuid, 'name': event.other.readable_name(True)} if event.other else None,
+                    'data': event.data,
+                }
+                for event in events],
+            'next': str(events[-1].id) if events else since,
         }
         return JsonResponse(data)
 
 
 class ApiCreateAv(APIView):
-    permission_classes = [HasAPIKey]
+    permission_classes = [CachedHasAPIKey]
 
     def post(self, request):
         r = request.query_params
@@ -523,7 +785,7 @@ class ApiCreateAv(APIView):
         return HttpResponse('Successfully created AV: "{}"'.format(av.av_code))
 
 class ApiCreateBodyArmor(APIView):
-    permission_classes = [HasAPIKey]
+    permission_classes = [CachedHasAPIKey]
 
     def post(self, request):
         r = request.query_params
@@ -551,11 +813,11 @@ def view_tags(request):
     return render(request, "tags_user.html", {'tags':tags})
 
 def profile_picture_view(request, player_uuid, fname):
-    if request.user.is_authenticated or Person.objects.get(player_uuid=player_uuid).admin_this_game:
-        new_url = f'{os.path.split(MEDIA_ROOT)[0]}{request.path}'
-    else:
-        new_url = f'{STATIC_ROOT}/images/noprofile.png'
-    return HttpResponse(open(new_url, "rb"))
+    return serve_profile_picture(request, player_uuid, fname)
+
+
+def signed_media_view(request, expires, signature, name):
+    return serve_signed_media(request, expires, signature, name)
 
 
 def view_announcement(request, announcement_id):
@@ -1,19 +1,19 @@
-import base64
 import html
-import random
-import sys
-from io import BytesIO
+import os
 
-from PIL import Image
-from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.db.models import Q
 from django.http import JsonResponse
 from django.utils import timezone
 from rest_framework.decorators import api_view
+from rest_framework_api_key.models import APIKey
 
+from .clans import replace_banned_leader
 from .decorators import admin_required_api
-from .models import BodyArmor, Clan, ClanHistoryItem, NameChangeRequest, OZEntry, Person, PlayerStatus, Tag
+from .images import ingest_webcam_photo
+from .media import profile_picture_srcset, profile_picture_url
+from .models import BodyArmor, NameChangeRequest, OZEntry, Person, PlayerStatus, Tag
 from .models import get_active_game, generate_tag_id
+from .permissions import api_key_cache_stats
 from .views import for_all_methods
 from .views_html_admin import AdminHTMLViews
 
@@ -77,40 +77,8 @@ class AdminAPIViews(object):
             player.ban_timestamp = timezone.now()
             player.clan = None
             player.save()
-            existing_leadership = Clan.objects.filter(leader=player)
             # Remove from leadership of any clans
-            for led_clan in existing_leadership:
-                ClanHistoryItem(clan=led_clan, actor=player, history_item_type="a").save() # "Leader banned" history item
-                other_members = Person.objects.filter(clan=led_clan)
-
-                # If this clan didn't have any other members, disband it
-                if other_members.count() == 0:
-                    led_clan.leader = None
-                    led_clan.disband_timestamp = timezone.now()
-                    led_clan.save()
-                    ClanHistoryItem(clan=led_clan, history_item_type="e").save() # "Disbanded by system" history item
-
-                # Otherwise, attempt to find a suitable new leader
-                else:
-                    suitable_leaders = other_members.filter(playerstatus__game=get_active_game(), playerstatus__status__in=['h','v','e','z','o','x','a','m'])
-
-                    # If no suitable leaders can be found, disband the clan
-                    if suitable_leaders.count() == 0:
-                        for clan_member in other_members:
-                            clan_member.clan = None
-                            clan_member.save()
-                        
-                        led_clan.leader = None
-                        led_clan.disband_timestamp = timezone.now()
-                        led_clan.save()
-                        ClanHistoryItem(clan=led_clan, history_item_type="e").save() # "Disbanded by system" history item
-                    
-                    # Otherwise, pick a new leader at random
-                    else:
-                        new_leader = random.choice(suitable_leaders)
-                        led_clan.leader = new_leader
-                        led_clan.save()
-                        ClanHistoryItem(clan=led_clan, actor=new_leader, history_item_type="b").save() # "Promoted to leader by system" history item
+            replace_banned_leader(player)
 
         else:
             return JsonResponse({'status': 'fail', 'error': "unknown command"})          
@@ -169,7 +137,7 @@ class AdminAPIViews(object):
 
                 result.append({
                     "name": f"""<a class="dt_name_link" href="/player/{person.player_uuid}/">{person.readable_name(True)}</a>""",
-                    "pic": f"""<a class="dt_profile_link" href="/player/{person.player_uuid}/"><img src='{person.picture_url}' class='dt_profile' /></a>""",
+                    "pic": f"""<a class="dt_profile_link" href="/player/{person.player_uuid}/"><img src='{profile_picture_url(person, request.user, '96')}' srcset='{profile_picture_srcset(person, request.user)}' sizes='70px' class='dt_profile' /></a>""",
                     "loan": f"""<input type="button" value="Loan" class="dt_loan_button" id="{person.player_uuid}" onclick="loan_to(this)" />""",
                     "DT_RowData": {"person_url": f"/player/{person.player_uuid}/", "clan_url": f"/clan/{person.clan.name}/" if person.clan is not None else ""}
                 })
@@ -217,7 +185,7 @@ class AdminAPIViews(object):
                     disabled = 'disabled'
                 result.append({
                     "name": f"""{html.escape(person.readable_name(True))}""",
-                    "pic": f"""<img src='{person.picture_url}' class='dt_profile' />""",
+                    "pic": f"""<img src='{profile_picture_url(person, request.user, '96')}' srcset='{profile_picture_srcset(person, request.user)}' sizes='70px' class='dt_profile' />""",
                     "email": f"""{html.escape(person.email)}""",
                     "DT_RowClass": {"h": "dt_human", "v": "dt_human", "a": "dt_admin", "z": "dt_zombie", "o": "dt_zombie", "n": "dt_nonplayer", "x": "dt_zombie", "m": "dt_mod"}[person.current_status.status],
                     "activation_link": f"""<button type="button" class="btn btn-primary" data-bs-toggle="modal" data-bs-target="#activationmodal" data-bs-activationname="{html.escape(person.first_name)} {html.escape(person.last_name)}" data-bs-activationid="{person.player_uuid}" {disabled}>Register</button>"""
@@ -237,16 +205,7 @@ class AdminAPIViews(object):
         game = get_active_game()
         try:
             requested_player = Person.objects.get(player_uuid=request.POST["activated_player"])
-            image_base64 = request.POST['player_photo'].replace('data:image/jpeg;base64,', '').replace(" ","+")
-            im_bytes = base64.b64decode(image_base64)   # im_bytes is a binary image
-            im_file = BytesIO(im_bytes)  # convert image to file-like object
-            img = Image.open(im_file)   # img is now PIL Image object
-            output = BytesIO()
-            im = img.convert('RGB')
-            im.thumbnail( (400, 400) , Image.Resampling.LANCZOS )
-            im.save(output, format="JPEG", quality=95)
-            output.seek(0)
-            requested_player.picture = InMemoryUploadedFile(output,'ImageField', "%s.jpg" % requested_player.player_uuid, 'image/jpeg', sys.getsizeof(output), None)
+            requested_player.picture = ingest_webcam_photo(request.POST['player_photo'], f"{requested_player.player_uuid}.jpg")
             person_status = PlayerStatus.objects.get(player=requested_player, game=game)
             person_status.activation_timestamp = timezone.now()
             person_status.status = 'h'
@@ -282,7 +241,7 @@ class AdminAPIViews(object):
         result = [
             {
                 "name": f"{player_status.player.readable_name(True)}",
-                "pic": f"<img src='{player_status.player.picture_url}' class='dt_profile' />",
+                "pic": f"<img src='{profile_picture_url(player_status.player, request.user, '96')}' srcset='{profile_picture_srcset(player_status.player, request.user)}' sizes='70px' class='dt_profile' />",
                 "email": f"{player_status.player.email}",
                 "uuid": f"{player_status.player.player_uuid}",
                 "DT_RowClass": {"h": "dt_human", "v": "dt_human", "a": "dt_admin", "z": "dt_zombie", "o": "dt_zombie", "n": "dt_nonplayer", "x": "dt_zombie", "m": "dt_mod"}[player_status.status],
@@ -397,3 +356,15 @@ class AdminAPIViews(object):
             return JsonResponse({"status":"success"})
         except Exception as e:
             return JsonResponse({"status":"error", "error": str(e)})
+
+    @api_view(["GET"])
+    def api_key_stats(request):
+        '''
+        Shows how often each API key was verified from the cache by the worker process serving this request.
+        '''
+        stats = api_key_cache_stats()
+        names = dict(APIKey.objects.filter(prefix__in=stats.keys()).values_list('prefix', 'name'))
+        return JsonResponse({
+            "pid": os.getpid(),
+            "keys": {prefix: {"name": names.get(prefix), **key_stats} for prefix, key_stats in stats.items()},
+        })
@@ -1,10 +1,14 @@
 
+from django.core.paginator import Paginator
+from django.db import transaction
 from django.http import JsonResponse
 from django.utils import timezone
 from rest_framework.decorators import api_view
 
+from .clans import disband_clan
 from .decorators import authentication_required_api
-from .models import Clan, ClanHistoryItem, ClanInvitation, ClanJoinRequest, Person
+from .models import Clan, ClanHistoryItem, ClanInvitation, ClanJoinRequest, Notification, Person
+from .notifications import NOTIFICATIONS_PAGE_SIZE, mark_read
 from .views import for_all_methods
 
 
@@ -72,25 +76,12 @@ class UserAPIViews(object):
         if command == "cancel_invite":
             if request.user == target:
                 return JsonResponse({"status":"cannot cancel invite to self"})
-            invites = ClanInvitation.objects.filter(invitee=target, clan=clan)
-            done_something = False
-            for invite in invites:
-                invite.status = 'e'
-                invite.response_timestamp = timezone.now()
-                invite.save()
-                done_something = True
-            if done_something:
+            cancelled = ClanInvitation.objects.filter(invitee=target, clan=clan).update(status='e', response_timestamp=timezone.now())
+            if cancelled:
                 return JsonResponse({"status":"success"})
             return JsonResponse({"status":"no invites to cancel"})
         if command == "disband":
-            clan.disband_timestamp = timezone.now()
-            clan.leader = None
-            clan.save()
-            for member in Person.objects.filter(clan=clan):
-                member.clan = None
-                member.save()
-            new_history_item = ClanHistoryItem.objects.create(clan=clan, actor=request.user, history_item_type='d')
-            new_history_item.save()
+            disband_clan(clan, request.user)
             return JsonResponse({"status":"success"})
 
 
@@ -102,18 +93,19 @@ class UserAPIViews(object):
         if invite.status != "n":
             return JsonResponse({"status","invitation already responded to"})
         if command == "accept":
-            invite.status = "a"
-            invite.response_timestamp = timezone.now()
-            invite.save()
-            request.user.clan = invite.clan
-            request.user.save()
-            other_invitations = ClanInvitation.objects.filter(invitee=request.user, status='n')
-            for other_invitation in other_invitations:
-                other_invitation.status = 'e'
-                other_invitation.response_timestamp = timezone.now()
-                other_invitation.save()
-            new_history_item = ClanHistoryItem.objects.create(clan=invite.clan, actor=request.user, history_item_type='i')
-            new_history_item.save()
+            with transaction.atomic():
+                # Lock the user's open invitations so two of them can't be accepted at once
+                if invite.id not in ClanInvitation.objects.select_for_update().filter(invitee=request.user, status='n').values_list('id', flat=True):
+                    return JsonResponse({"status":"invitation already responded to"})
+                # Waits for a disband in progress (see clans.disband_clan), and holds one off until the user has joined
+                if not Clan.objects.select_for_update().filter(pk=invite.clan_id, disband_timestamp__isnull=True).first():
+                    return JsonResponse({"status":"clan has been disbanded"})
+                now = timezone.now()
+                ClanInvitation.objects.filter(id=invite.id).update(status='a', response_timestamp=now)
+                ClanInvitation.objects.filter(invitee=request.user, status='n').update(status='e', response_timestamp=now)
+                request.user.clan = invite.clan
+                request.user.save()
+                ClanHistoryItem.objects.create(clan=invite.clan, actor=request.user, history_item_type='i')
             return JsonResponse({"status":"success", "redirect_url": f"/clan/{invite.clan.name}/"})
         if command == "reject":
             invite.status = "r"
@@ -130,18 +122,19 @@ class UserAPIViews(object):
         if joinrequest.status != "n":
             return JsonResponse({"status","request already responded to"})
         if command == "accept":
-            joinrequest.status = "a"
-            joinrequest.response_timestamp = timezone.now()
-            joinrequest.save()
-            joinrequest.requestor.clan = joinrequest.clan
-            joinrequest.requestor.save()
-            other_requests = ClanJoinRequest.objects.filter(requestor=joinrequest.requestor, status='n')
-            for other_request in other_requests:
-                other_request.status = 'e'
-                other_request.response_timestamp = timezone.now()
-                other_request.save()
-            new_history_item = ClanHistoryItem.objects.create(clan=joinrequest.clan, actor=request.user, other=joinrequest.requestor, history_item_type='r')
-            new_history_item.save()
+            with transaction.atomic():
+                # Lock the requestor's open requests so two clans can't accept them at once
+                if joinrequest.id not in ClanJoinRequest.objects.select_for_update().filter(requestor=joinrequest.requestor, status='n').values_list('id', flat=True):
+                    return JsonResponse({"status":"request already responded to"})
+                # Waits for a disband in progress (see clans.disband_clan), and holds one off until the requestor has joined
+                if not Clan.objects.select_for_update().filter(pk=joinrequest.clan_id, disband_timestamp__isnull=True).first():
+                    return JsonResponse({"status":"clan has been disbanded"})
+                now = timezone.now()
+                ClanJoinRequest.objects.filter(id=joinrequest.id).update(status='a', response_timestamp=now)
+                ClanJoinRequest.objects.filter(requestor=joinrequest.requestor, status='n').update(status='e', response_timestamp=now)
+                joinrequest.requestor.clan = joinrequest.clan
+                joinrequest.requestor.save()
+                ClanHistoryItem.objects.create(clan=joinrequest.clan, actor=request.user, other=joinrequest.requestor, history_item_type='r')
             return JsonResponse({"status":"success"})
         if command == "reject":
             joinrequest.status = "r"
@@ -149,4 +142,29 @@ class UserAPIViews(object):
             joinrequest.save()
             return JsonResponse({"status":"success"})
         
-    
\ No newline at end of file
+    
+
+    @api_view(["GET"])
+    def notifications_api(request):
+        page = Paginator(Notification.objects.filter(recipient=request.user), NOTIFICATIONS_PAGE_SIZE).get_page(request.query_params.get('page'))
+        return JsonResponse({
+            "notifications": [{
+                "id": notification.id,
+                "kind": notification.get_kind_display(),
+                "message": notification.message,
+                "link": notification.link,
+                "timestamp": notification.timestamp,
+                "read": notification.read,
+            } for notification in page],
+            "page": page.number,
+            "pages": page.paginator.num_pages,
+            "unread": request.user.unread_notifications,
+        })
+
+
+    @api_view(["POST"])
+    def notifications_mark_read(request):
+        # Marks the notifications given as `id` (any number of times), or all of them if none are given
+        ids = [int(notification_id) for notification_id in request.POST.getlist('id') if notification_id.isdigit()]
+        marked = mark_read(request.user, ids if 'id' in request.POST else None)
+        return JsonResponse({"status": "success", "marked": marked, "unread": max(request.user.unread_notifications - marked, 0)})
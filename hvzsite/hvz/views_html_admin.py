@@ -1,11 +1,12 @@
 from django.contrib.sites.shortcuts import get_current_site
-from django.db.models import Q, Count
+from django.db.models import Q, Count, Max
 from django.db.models.functions import Lower
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 
+from .cards import PRINT_QUEUE_BATCH_SIZE, card_records, outstanding_cards, record_printed_cards, render_card_sheets
 from .decorators import admin_required
 from .forms import AboutUpdateForm, AnnouncementForm, AVCreateForm, BlasterApprovalForm, BodyArmorCreateForm, \
     MissionForm, PostGameSurveyForm, ReportUpdateForm, RulesUpdateForm, ScoreboardForm
@@ -16,6 +17,24 @@ from .models import BadgeType
 from .models import get_active_game, reset_active_game
 from .views import for_all_methods
 
+# {format: (content type, file extension)} of the downloadable ID card sheets
+CARD_SHEET_FORMATS = {'pdf': ('application/pdf', 'pdf'), 'svg': ('application/zip', 'zip')}
+
+
+def card_sheet_response(request, statuses, preview):
+    '''
+    Renders the ID cards of some PlayerStatuses as print-ready sheets (in the format asked for by the request),
+    streamed to the client as they are rendered.
+    '''
+    records = card_records(statuses)
+    if not records:
+        return HttpResponse("No cards to print!")
+    content_type, extension = CARD_SHEET_FORMATS[request.GET['format']]
+    sheets = render_card_sheets(records, request.GET['format'], preview, f"{request.scheme}://{get_current_site(request)}")
+    response = StreamingHttpResponse(sheets, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="id_cards_{timezone.localtime():%Y-%m-%d_%H%M}.{extension}"'
+    return response
+
 
 @for_all_methods(admin_required)
 class AdminHTMLViews(object):
@@ -206,7 +225,8 @@ class AdminHTMLViews(object):
 
     def reports(request):
         game = get_active_game()
-        reports = Report.objects.filter(game=game)
+        reports = Report.objects.filter(game=game).select_related("reporter").prefetch_related("attachments", "reportees") \
+            .annotate(last_update_timestamp=Max("reportupdate__timestamp"))
         context = {"reports": reports.order_by("-timestamp")}
         return render(request, "reports.html", context)
 
@@ -289,8 +309,11 @@ class AdminHTMLViews(object):
 
 
     def print_one(request, player_uuid):
+        statuses = PlayerStatus.objects.filter(player__player_uuid=player_uuid, game=get_active_game())
+        if request.GET.get('format') in CARD_SHEET_FORMATS:
+            return card_sheet_response(request, statuses, False)
         context = {
-            "players": Person.objects.filter(player_uuid=player_uuid),
+            "cards": card_records(statuses),
             "preview": False,
             "print_one": True,
             "url": f"{request.scheme}://{get_current_site(request)}"
@@ -306,8 +329,10 @@ class AdminHTMLViews(object):
                                                ~Q(status='n') &
                                                Q(activation_timestamp__gte=start) &
                                                Q(activation_timestamp__lte=end)).order_by(Lower('player__first_name'), Lower('player__last_name'))
+        if query_vals.get('format') in CARD_SHEET_FORMATS:
+            return card_sheet_response(request, to_print, 'preview' in query_vals)
         context = {
-            "players": [status.player for status in to_print],
+            "cards": card_records(to_print),
             "preview": 'preview' in query_vals,
             "print_one": False,
             "url": f"{request.scheme}://{get_current_site(request)}"
@@ -317,10 +342,32 @@ class AdminHTMLViews(object):
     def print_choice(request):
         return render(request, "print_cards_choice.html")
 
-    # TODO: This should become unused and safe to remove
-    # def mark_printed(request):
-    #     PlayerStatus.objects.filter(printed=False, game=get_active_game()).filter(~Q(status='n')).update(printed=True)
-    #     return HttpResponseRedirect("/")
+    def print_queue(request):
+        queue = outstanding_cards(get_active_game())
+        if request.GET.get('format') in CARD_SHEET_FORMATS:
+            # Download the batch shown on the page, even if the queue changed since it was loaded
+            ids = [int(status_id) for status_id in request.GET.getlist('ids') if status_id.isdigit()]
+            return card_sheet_response(request, queue.filter(id__in=ids), False)
+        context = {
+            "cards": card_records(queue[:PRINT_QUEUE_BATCH_SIZE]),
+            "outstanding": queue.count(),
+            "preview": False,
+            "print_one": False,
+            "queue": True,
+            "url": f"{request.scheme}://{get_current_site(request)}"
+        }
+        return render(request, "print_cards.html", context)
+
+    def mark_printed(request):
+        if request.method == "POST":
+            printed = {}
+            # Each value is "<PlayerStatus id>:<the codes on the printed card>"
+            for value in request.POST.getlist('printed'):
+                status_id, _, codes = value.partition(':')
+                if status_id.isdigit() and codes:
+                    printed[int(status_id)] = codes
+            record_printed_cards(printed)
+        return HttpResponseRedirect("/admin/print_queue/")
 
 
     def view_failed_av_list(request):
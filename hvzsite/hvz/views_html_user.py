@@ -1,12 +1,14 @@
 from datetime import timedelta
 
+from django.core.paginator import Paginator
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
 from django.utils import timezone
 
 from .decorators import authentication_required
 from .forms import ClanCreateForm, NameChangeForm
-from .models import Clan, ClanHistoryItem, DiscordLinkCode, NameChangeRequest
+from .models import Clan, ClanHistoryItem, ClanInvitation, ClanJoinRequest, DiscordLinkCode, NameChangeRequest, Notification
+from .notifications import NOTIFICATIONS_PAGE_SIZE
 from .views import for_all_methods, player_view
 
 
@@ -15,6 +17,16 @@ class UserHTMLViews(object):
     def me(request):
         return player_view(request, request.user.player_uuid)
 
+    def notifications(request):
+        page = Paginator(Notification.objects.filter(recipient=request.user), NOTIFICATIONS_PAGE_SIZE).get_page(request.GET.get('page'))
+        context = {
+            'notifications': page,
+            'unanswered_invitations': ClanInvitation.objects.filter(invitee=request.user, status='n').select_related('inviter', 'clan'),
+            'unanswered_requests': ClanJoinRequest.objects.filter(clan__leader=request.user, status='n').select_related('requestor', 'clan'),
+            'name_changes_waiting': request.user.admin_this_game and NameChangeRequest.objects.filter(request_status='n').exists(),
+        }
+        return render(request, "notifications.html", context)
+
     def discord_link(request):
         user = request.user
         link_codes = DiscordLinkCode.objects.filter(account=user)
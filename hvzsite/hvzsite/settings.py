@@ -91,7 +91,8 @@ TEMPLATES = [
                 'django.contrib.messages.context_processors.messages',
                 'hvz.contextprocessors.notification_context_processor.get_notifications',
                 'hvz.contextprocessors.announcement_context_processor.get_announcements',
-                'hvz.contextprocessors.banned_context_processor.is_player_banned'
+                'hvz.contextprocessors.banned_context_processor.is_player_banned',
+                'hvz.contextprocessors.navbar_context_processor.get_navbar'
             ],
         },
     },
@@ -118,6 +119,24 @@ STATIC_ROOT = os.path.join(BASE_DIR,"static_root")
 MEDIA_ROOT = os.path.join(BASE_DIR,"media")
 MEDIA_URL = '/media/'
 
+# Access-controlled media (e.g. profile pictures) is checked by Django but its body can be handed to the
+# front-end server: None streams it from Django, 'x-accel-redirect' is for nginx, 'x-sendfile' for apache/lighttpd.
+# With nginx, MEDIA_ACCEL_REDIRECT_PREFIX must be an `internal` location aliased to MEDIA_ROOT.
+MEDIA_SENDFILE = SECRET_SETTINGS['media_sendfile'] if 'media_sendfile' in SECRET_SETTINGS else None
+MEDIA_ACCEL_REDIRECT_PREFIX = SECRET_SETTINGS['media_accel_redirect_prefix'] if 'media_accel_redirect_prefix' in SECRET_SETTINGS else '/protected_media/'
+
+# Pages link access-controlled media through signed URLs (see hvz/media.py) that stay valid for at least this many
+# seconds. Expiry is rounded to a multiple of this, so repeat visits within a window reuse the browser's cached copy.
+SIGNED_MEDIA_URL_LIFETIME = SECRET_SETTINGS['signed_media_url_lifetime'] if 'signed_media_url_lifetime' in SECRET_SETTINGS else 6 * 60 * 60
+
+# Shared cache. Defaults to a per-process memory cache; configure a shared backend (e.g. redis or memcached)
+# when running more than one worker process so invalidations reach every process.
+CACHES = SECRET_SETTINGS['caches'] if 'caches' in SECRET_SETTINGS else {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -210,4 +229,23 @@ CAPTCHA_CHALLENGE_FUNCT = 'captcha.helpers.random_char_challenge'
 CAPTCHA_LENGTH = 6
 CAPTCHA_NOISE_FUNCTIONS = ('captcha.helpers.noise_dots',)
 
-LOGGING = SECRET_SETTINGS['logging'] if 'logging' in SECRET_SETTINGS else {}
\ No newline at end of file
+LOGGING = SECRET_SETTINGS['logging'] if 'logging' in SECRET_SETTINGS else {}
+
+# How old a report or game event must be before /api/reports and /api/events list it. Rows are timestamped before
+# their transaction commits, so a slow commit could otherwise land behind a cursor a client already holds.
+# Raise it if commits can take longer than this (e.g. under heavy database load)
+FEED_SETTLE_SECONDS = SECRET_SETTINGS['feed_settle_seconds'] if 'feed_settle_seconds' in SECRET_SETTINGS else 10
+
+# Most requests to /api/events that may wait for new events at once in each worker process (see hvz/events.py).
+# Each one holds a worker thread and a database connection for up to 25 seconds, so size the threads per process
+# (and the database's connection limit) for these on top of normal traffic. Requests over the limit return at once
+EVENTS_MAX_WAITING = SECRET_SETTINGS['events_max_waiting'] if 'events_max_waiting' in SECRET_SETTINGS else 4
+
+# Number of background workers that generate resized pictures from uploads (see hvz/images.py)
+IMAGE_PROCESSING_WORKERS = SECRET_SETTINGS['image_processing_workers'] if 'image_processing_workers' in SECRET_SETTINGS else os.cpu_count()
+
+# Largest photo (in bytes, after base64 decoding) accepted from the webcam at player activation
+WEBCAM_PHOTO_MAX_SIZE = SECRET_SETTINGS['webcam_photo_max_size'] if 'webcam_photo_max_size' in SECRET_SETTINGS else 2 * 1024 * 1024
+
+# TrueType font used on generated ID card sheets (see hvz/cards.py). Defaults to Pillow's built-in font
+ID_CARD_FONT = SECRET_SETTINGS['id_card_font'] if 'id_card_font' in SECRET_SETTINGS else None
\ No newline at end of file